@@ -0,0 +1,110 @@
+"""
+Fake Telegram Bot API server for load tests.
+
+Point the bot at it with TELEGRAM_API_BASE_URL=http://127.0.0.1:<port>. It
+answers the methods the bot uses with plausible objects, adds a configurable
+latency to every call, and can answer with 429 + retry_after once more than
+`flood_limit` messages per second are sent, like the real API does.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "editMessageText"}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, flood_limit: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_limit = flood_limit
+        self.calls = Counter()
+        self.flood_errors = 0
+        self._message_id = 0
+        self._file_id = 0
+        self._window_start = time.monotonic()
+        self._window_sends = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    @staticmethod
+    async def _params(request: web.Request) -> dict:
+        # python-telegram-bot posts form fields (multipart when uploading) with JSON-encoded values
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _flooded(self) -> bool:
+        if not self.flood_limit:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start, self._window_sends = now, 0
+        self._window_sends += 1
+        return self._window_sends > self.flood_limit
+
+    def _message(self, chat_id, **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            **extra,
+        }
+
+    def _file(self) -> dict:
+        self._file_id += 1
+        return {"file_id": f"fake-file-{self._file_id}", "file_unique_id": f"u{self._file_id}"}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if method in SEND_METHODS and self._flooded():
+            self.flood_errors += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            })
+
+        if method == "getMe":
+            result = {
+                "id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False,
+            }
+        elif method == "sendMessage":
+            result = self._message(params["chat_id"], text=params.get("text", ""))
+        elif method == "editMessageText":
+            result = self._message(params.get("chat_id", 1), text=params.get("text", ""))
+        elif method == "sendPhoto":
+            photo = self._file()
+            result = self._message(params["chat_id"], photo=[{**photo, "width": 1080, "height": 1920}])
+        elif method == "sendDocument":
+            result = self._message(params["chat_id"], document=self._file())
+        elif method in ("answerCallbackQuery", "deleteWebhook", "setWebhook"):
+            result = True
+        elif method == "getUpdates":
+            await asyncio.sleep(1)
+            result = []
+        else:
+            return web.json_response({"ok": False, "error_code": 404, "description": f"Unknown method {method}"})
+        return web.json_response({"ok": True, "result": result})
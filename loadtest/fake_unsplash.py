@@ -0,0 +1,71 @@
+"""
+Fake Unsplash API + image CDN for load tests.
+
+Point the bot at it with UNSPLASH_API_URL=http://127.0.0.1:<port>.
+/photos/random returns `count` photos drawn from a fixed pool per query (so
+repeated fetches return duplicates, as the real endpoint does), with
+X-Ratelimit-* headers. After `quota` requests in the current hour it answers
+403 "Rate Limit Exceeded". Photo URLs point back at /img/<id>.jpg on this
+server, which serves deterministic bytes.
+"""
+import asyncio
+import hashlib
+import random
+import time
+
+from aiohttp import web
+
+
+class FakeUnsplash:
+    def __init__(self, latency: float = 0.2, quota: int = 50, pool_size: int = 200, image_bytes: int = 200_000):
+        self.latency = latency
+        self.quota = quota
+        self.pool_size = pool_size
+        self.image_bytes = image_bytes
+        self.requests = 0
+        self.forbidden = 0
+        self.image_downloads = 0
+        self._hour_start = time.monotonic()
+        self._used = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/photos/random", self.random_photos)
+        app.router.add_get("/img/{photo_id}.jpg", self.image)
+        return app
+
+    def _remaining(self) -> int:
+        if time.monotonic() - self._hour_start >= 3600:
+            self._hour_start, self._used = time.monotonic(), 0
+        return max(0, self.quota - self._used)
+
+    async def random_photos(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self._remaining() == 0:
+            self.forbidden += 1
+            return web.Response(
+                status=403, text="Rate Limit Exceeded",
+                headers={"X-Ratelimit-Limit": str(self.quota), "X-Ratelimit-Remaining": "0"},
+            )
+        self._used += 1
+
+        query = request.query.get("query", "")
+        count = min(int(request.query.get("count", "1")), 30)
+        base = f"{request.scheme}://{request.host}"
+        slug = hashlib.sha1(query.encode()).hexdigest()[:8]
+        photos = []
+        for n in random.sample(range(self.pool_size), min(count, self.pool_size)):
+            photo_id = f"{slug}{n:05d}"
+            photos.append({"id": photo_id, "urls": {"regular": f"{base}/img/{photo_id}.jpg"}})
+        return web.json_response(photos, headers={
+            "X-Ratelimit-Limit": str(self.quota),
+            "X-Ratelimit-Remaining": str(self._remaining()),
+        })
+
+    async def image(self, request: web.Request) -> web.Response:
+        self.image_downloads += 1
+        await asyncio.sleep(self.latency)
+        seed = hashlib.sha256(request.match_info["photo_id"].encode()).digest()
+        body = (seed * (self.image_bytes // len(seed) + 1))[:self.image_bytes]
+        return web.Response(body=body, content_type="image/jpeg")
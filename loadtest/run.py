@@ -0,0 +1,284 @@
+"""
+End-to-end load test of the bot against local stand-ins.
+
+    docker compose -f loadtest/docker-compose.yml up -d
+    python -m loadtest.run --users 2000 --concurrency 200 --fresh
+
+Starts the fake Telegram and Unsplash servers, points the bot at them and at
+the load-test MariaDB, then plays one day for N users:
+
+  1) /start from every user
+  2) the morning broadcast
+  3) a category tap from every user (wide users also open a main category first)
+  4) the nightly usage broadcast
+  5) a usage reply from everyone who got a wallpaper
+
+and reports p50/p95/p99 handler latency, throughput and DB round trips per
+update for each phase, plus the broadcast rates.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+
+from aiohttp import web
+
+from loadtest.fake_telegram import FakeTelegram
+from loadtest.fake_unsplash import FakeUnsplash
+
+FIRST_USER_ID = 5_000_000_000
+
+
+def configure_env(args):
+    # Set before main is imported; main's load_dotenv() does not override existing variables.
+    # DB settings are forced so a run can never touch the database configured in .env.
+    os.environ.update({
+        "DB_HOST": args.db_host,
+        "DB_PORT": str(args.db_port),
+        "DB_USER": args.db_user,
+        "DB_PASS": args.db_pass,
+        "DB_NAME": args.db_name,
+        "BOT_TOKEN": "123456:loadtest",
+        "BOT_OWNER_ID": "1",
+        "BOT_OWNER_ID2": "2",
+        "BOT_OWNER_ID3": "3",
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "UNSPLASH_API_URL": f"http://127.0.0.1:{args.unsplash_port}",
+        "UNSPLASH_ACCESS_KEY": "loadtest",
+        "IMAGE_STORE_DIR": tempfile.mkdtemp(prefix="wallpaper-loadtest-"),
+        "BROADCAST_MESSAGES_PER_SECOND": str(args.broadcast_rate),
+        # One morning run for the whole audience, so the phase measures the broadcast itself
+        "MORNING_WINDOW_MINUTES": "0",
+    })
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def reset_database(bot):
+    if "loadtest" not in bot.DB_NAME:
+        raise SystemExit(f"Refusing to wipe database '{bot.DB_NAME}': its name does not contain 'loadtest'")
+    conn = bot.get_connection()
+    try:
+        c = conn.cursor()
+        c.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE()")
+        tables = [row[0] for row in c.fetchall()]
+        c.execute("SET FOREIGN_KEY_CHECKS = 0")
+        for table in tables:
+            c.execute(f"DROP TABLE IF EXISTS `{table}`")
+        conn.commit()
+        c.close()
+    finally:
+        conn.close()
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Recorder:
+    def __init__(self, bot):
+        self.bot = bot
+        self.latencies = defaultdict(list)
+        self.phases = []
+
+    async def timed(self, label, coro):
+        started = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.latencies[label].append(time.perf_counter() - started)
+
+    async def phase(self, name, updates, run_one, concurrency):
+        """Run `run_one(update)` for every update with bounded concurrency and record the phase totals."""
+        semaphore = asyncio.Semaphore(concurrency)
+        queries_before = self.bot.db_stats.queries
+
+        async def worker(update):
+            async with semaphore:
+                await run_one(update)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(u) for u in updates))
+        await self.bot.write_buffer.flush()
+        elapsed = time.perf_counter() - started
+        self.phases.append((name, len(updates), elapsed, self.bot.db_stats.queries - queries_before))
+
+    async def job(self, name, coro, messages_before, messages_after):
+        queries_before = self.bot.db_stats.queries
+        started = time.perf_counter()
+        await coro
+        elapsed = time.perf_counter() - started
+        self.phases.append((name, messages_after() - messages_before, elapsed, self.bot.db_stats.queries - queries_before))
+
+    def report(self):
+        print("\nPhases")
+        print(f"  {'phase':<28}{'items':>8}{'seconds':>10}{'items/s':>10}{'DB/item':>10}")
+        for name, items, elapsed, queries in self.phases:
+            rate = items / elapsed if elapsed else 0
+            per_item = queries / items if items else 0
+            print(f"  {name:<28}{items:>8}{elapsed:>10.2f}{rate:>10.1f}{per_item:>10.2f}")
+        print("\nLatency (ms)")
+        print(f"  {'handler':<28}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+        for label, values in sorted(self.latencies.items()):
+            ms = [v * 1000 for v in values]
+            print(f"  {label:<28}{len(ms):>8}{percentile(ms, 50):>10.1f}{percentile(ms, 95):>10.1f}"
+                  f"{percentile(ms, 99):>10.1f}{max(ms):>10.1f}")
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+
+def start_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user_payload(user_id),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "prompt",
+            },
+        },
+    }
+
+
+async def run(args):
+    configure_env(args)
+    telegram = FakeTelegram(latency=args.telegram_latency, flood_limit=args.telegram_flood_limit)
+    unsplash = FakeUnsplash(latency=args.unsplash_latency, quota=args.unsplash_quota, pool_size=args.photo_pool)
+    runners = [
+        await start_site(telegram.app(), args.telegram_port),
+        await start_site(unsplash.app(), args.unsplash_port),
+    ]
+
+    import main as bot
+    from telegram import Update
+    from telegram.ext import CallbackContext
+
+    if args.fresh:
+        reset_database(bot)
+    bot.init_db()
+    application = bot.build_application()
+    recorder = Recorder(bot)
+
+    # Time send_wallpaper_to_user on its own as well as the handlers that call it
+    send_wallpaper_to_user = bot.send_wallpaper_to_user
+
+    async def timed_send_wallpaper(*a, **kw):
+        return await recorder.timed("send_wallpaper_to_user", send_wallpaper_to_user(*a, **kw))
+
+    bot.send_wallpaper_to_user = timed_send_wallpaper
+
+    update_ids = iter(range(1, 10 ** 9))
+    user_ids = [FIRST_USER_ID + n for n in range(args.users)]
+    sent_messages = lambda: telegram.calls["sendMessage"]
+
+    async with application:
+        await bot.on_startup(application)
+        context = CallbackContext(application)
+
+        async def process(label, data):
+            await recorder.timed(label, application.process_update(Update.de_json(data, application.bot)))
+
+        # 1) /start
+        await recorder.phase(
+            "start_command", user_ids,
+            lambda uid: process("start_command", start_update(next(update_ids), uid)),
+            args.concurrency,
+        )
+
+        # 2) Morning broadcast
+        await recorder.job("morning_wallpaper_distribution",
+                           bot.morning_wallpaper_distribution(context), sent_messages(), sent_messages)
+
+        # 3) Category taps
+        async def tap(uid):
+            user = await bot.get_or_create_user_async(uid)
+            if user["group"] == "wide":
+                main_cat = random.choice(list(bot.wide_categories))
+                await process("wide_category_callback", callback_update(next(update_ids), uid, f"cat:{main_cat}"))
+                subcat = random.choice(bot.wide_categories[main_cat])
+                await process("wide_subcategory_callback",
+                              callback_update(next(update_ids), uid, f"subcat:{main_cat}:{subcat}"))
+            else:
+                cat = random.choice(bot.narrow_categories)
+                await process("narrow_category_callback", callback_update(next(update_ids), uid, f"narrow_cat:{cat}"))
+
+        tapping = random.sample(user_ids, int(len(user_ids) * args.tap_ratio))
+        await recorder.phase("category taps", tapping, tap, args.concurrency)
+
+        # 4) Nightly usage broadcast
+        await recorder.job("nightly_usage_prompt", bot.nightly_usage_prompt(context), sent_messages(), sent_messages)
+
+        # 5) Usage replies
+        await recorder.phase(
+            "usage replies", tapping,
+            lambda uid: process("usage_callback",
+                                callback_update(next(update_ids), uid, random.choice(["used:yes", "used:no"]))),
+            args.concurrency,
+        )
+
+        await bot.on_shutdown(application)
+
+    for runner in runners:
+        await runner.cleanup()
+
+    recorder.report()
+    print("\nFake Telegram calls:", dict(telegram.calls), f"(429s: {telegram.flood_errors})")
+    print(f"Fake Unsplash: {unsplash.requests} API requests, {unsplash.forbidden} x 403, "
+          f"{unsplash.image_downloads} image downloads")
+    print(f"DB: {bot.db_stats.queries} round trips (statements, commits, pings), {bot.db_stats.seconds:.2f}s total")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100, help="updates processed at the same time")
+    parser.add_argument("--tap-ratio", type=float, default=0.8, help="share of users that pick a category")
+    parser.add_argument("--fresh", action="store_true", help="drop every table in the load-test DB first")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-flood-limit", type=int, default=30, help="messages/s before 429s, 0 = off")
+    parser.add_argument("--broadcast-rate", type=float, default=25)
+    parser.add_argument("--unsplash-port", type=int, default=8082)
+    parser.add_argument("--unsplash-latency", type=float, default=0.3)
+    parser.add_argument("--unsplash-quota", type=int, default=50, help="requests per hour before 403s")
+    parser.add_argument("--photo-pool", type=int, default=200, help="distinct photos per query")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=3307)
+    parser.add_argument("--db-user", default="root")
+    parser.add_argument("--db-pass", default="loadtest")
+    parser.add_argument("--db-name", default="wallpaper_loadtest")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,14 +1,33 @@
+import asyncio
+import functools
+import hashlib
+import heapq
+import json
+import mmap
 import logging
 
 import random
-import requests
+import signal
+import socket
+import sys
+import aiohttp
 # Removed `import sqlite3`
 import os
+import queue
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from datetime import time as dt_time
 import time
-from typing import Dict, Any, List
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional
 import pytz
+from flask import Flask, Response
+from werkzeug.serving import make_server
 
 import mysql.connector
 from mysql.connector import Error
@@ -19,18 +38,40 @@ from telegram import (
     InlineKeyboardButton,
     InlineKeyboardMarkup
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
 from telegram.ext import (
     Application,
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
-    JobQueue
+    JobQueue,
+    BaseUpdateProcessor
 )
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Alternative Bot API server, e.g. "http://127.0.0.1:8081"; defaults to api.telegram.org
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL")
 UNSPLASH_ACCESS_KEY = os.getenv("UNSPLASH_ACCESS_KEY")
+UNSPLASH_API_URL = os.getenv("UNSPLASH_API_URL", "https://api.unsplash.com")
+UNSPLASH_CONNECT_TIMEOUT = float(os.getenv("UNSPLASH_CONNECT_TIMEOUT", "3"))
+UNSPLASH_READ_TIMEOUT = float(os.getenv("UNSPLASH_READ_TIMEOUT", "10"))
+UNSPLASH_MAX_RETRIES = int(os.getenv("UNSPLASH_MAX_RETRIES", "2"))
+UNSPLASH_BACKOFF_BASE = float(os.getenv("UNSPLASH_BACKOFF_BASE", "0.5"))  # seconds
+# Our share of the Unsplash hourly quota, spread evenly over the hour by a token bucket
+UNSPLASH_REQUESTS_PER_HOUR = int(os.getenv("UNSPLASH_REQUESTS_PER_HOUR", "45"))
+UNSPLASH_BURST = int(os.getenv("UNSPLASH_BURST", "5"))
+# Tokens the nightly job leaves in the bucket so that user taps are not starved
+UNSPLASH_INTERACTIVE_RESERVE = int(os.getenv("UNSPLASH_INTERACTIVE_RESERVE", "2"))
+# How long a user tap may wait for a token before it gives up on Unsplash
+UNSPLASH_INTERACTIVE_MAX_WAIT = float(os.getenv("UNSPLASH_INTERACTIVE_MAX_WAIT", "2"))
+# Consecutive failed Unsplash calls (timeouts, 5xx, connection errors) before we stop calling it for a while
+UNSPLASH_BREAKER_FAILURES = int(os.getenv("UNSPLASH_BREAKER_FAILURES", "3"))
+UNSPLASH_BREAKER_COOLDOWN = float(os.getenv("UNSPLASH_BREAKER_COOLDOWN", "60"))  # seconds, doubles while it keeps failing
+UNSPLASH_BREAKER_MAX_COOLDOWN = float(os.getenv("UNSPLASH_BREAKER_MAX_COOLDOWN", "1800"))
+# How long to leave Unsplash alone once it reports the hourly quota as used up
+UNSPLASH_QUOTA_COOLDOWN = float(os.getenv("UNSPLASH_QUOTA_COOLDOWN", "600"))
 BOT_OWNER_ID = int(os.getenv("BOT_OWNER_ID"))
 BOT_OWNER_ID2 = int(os.getenv("BOT_OWNER_ID2"))
 BOT_OWNER_ID3 = int(os.getenv("BOT_OWNER_ID3"))
@@ -40,11 +81,127 @@ DB_PORT = os.getenv("DB_PORT")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 DB_NAME = os.getenv("DB_NAME")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_WAIT_WARN = float(os.getenv("DB_POOL_WAIT_WARN", "0.1"))  # log waits longer than this
+DB_POOL_PING_INTERVAL = float(os.getenv("DB_POOL_PING_INTERVAL", "30"))  # idle seconds before a health check
+# Threads that run blocking DB calls for the async handlers; defaults to the pool size so they never wait on it
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+
+# In-process cache of user rows
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))  # seconds
+# Memory for the in-process seen-image bitmaps (see SeenIndex); 0 disables them
+SEEN_INDEX_MAX_BYTES = int(os.getenv("SEEN_INDEX_MAX_BYTES", str(64 * 1024 ** 2)))
+
+# Nightly prefetch planning
+PREFETCH_PAGE_SIZE = int(os.getenv("PREFETCH_PAGE_SIZE", "30"))  # Unsplash's maximum for /photos/random
+PREFETCH_MAX_REQUESTS = int(os.getenv("PREFETCH_MAX_REQUESTS", "40"))
+# Unseen images per active user at which a category counts as well stocked
+PREFETCH_TARGET_HEADROOM = int(os.getenv("PREFETCH_TARGET_HEADROOM", "10"))
+# Users who picked a category within this many days count as its active users
+PREFETCH_ACTIVE_DAYS = int(os.getenv("PREFETCH_ACTIVE_DAYS", "14"))
+# Hours a prefetch keeps waiting out an unavailable Unsplash before leaving the rest for the next run
+PREFETCH_MAX_HOURS = float(os.getenv("PREFETCH_MAX_HOURS", "12"))
+
+# Refills of an empty category triggered by a user tap
+REFILL_PAGE_SIZE = int(os.getenv("REFILL_PAGE_SIZE", "30"))
+REFILL_NEGATIVE_TTL = float(os.getenv("REFILL_NEGATIVE_TTL", "300"))  # seconds
+
+# Local copy of wallpapers downloaded by the nightly prefetch; set IMAGE_STORE_DIR to "" to disable.
+# Workers download into it and the bot sends from it, so every process must see the same directory
+# (a shared volume when they run on separate hosts); startup refuses a directory that is not the one
+# the others registered in bot_state
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "image_store")
+IMAGE_STORE_MAX_BYTES = int(os.getenv("IMAGE_STORE_MAX_BYTES", str(2 * 1024 ** 3)))
+IMAGE_DOWNLOAD_CONCURRENCY = int(os.getenv("IMAGE_DOWNLOAD_CONCURRENCY", "4"))
+IMAGE_DOWNLOAD_TIMEOUT = float(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "60"))
+IMAGE_DOWNLOADS_PER_PREFETCH = int(os.getenv("IMAGE_DOWNLOADS_PER_PREFETCH", "500"))
+
+# How many already-claimed candidates a reservation skips before giving up
+RESERVE_MAX_ATTEMPTS = int(os.getenv("RESERVE_MAX_ATTEMPTS", "5"))
+
+# Counters and daily stats are buffered and written in one transaction this often (or at N events)
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL_MS", "50")) / 1000
+WRITE_BUFFER_MAX_EVENTS = int(os.getenv("WRITE_BUFFER_MAX_EVENTS", "200"))
+
+# Days of history the daily summary compares today against
+STATS_TREND_DAYS = int(os.getenv("STATS_TREND_DAYS", "7"))
+
+# Which unseen image a user gets next: "oldest", "newest" or "random"
+IMAGE_ORDER = os.getenv("IMAGE_ORDER", "oldest")
+
+# Broadcasts (morning prompt, nightly usage prompt)
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "500"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_MESSAGES_PER_SECOND = float(os.getenv("BROADCAST_MESSAGES_PER_SECOND", "25"))  # Telegram allows ~30/s
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "4"))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", "60"))  # seconds between owner updates
+# Broadcasts are split into this many delivery slot ranges (shards), which workers claim one at a time
+BROADCAST_SHARDS = int(os.getenv("BROADCAST_SHARDS", "8"))
+
+# Several instances can share one database; they coordinate through leases in MySQL
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}:{os.getpid()}"
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))  # seconds a lease survives without being renewed
+LEASE_RENEW_INTERVAL = float(os.getenv("LEASE_RENEW_INTERVAL", "10"))
+# Seconds between snapshots of this process's Unsplash, cache and index state for the daily summary
+INSTANCE_REPORT_INTERVAL = float(os.getenv("INSTANCE_REPORT_INTERVAL", "60"))
+
+# Batch jobs (broadcasts, prefetch, summaries) go through a task queue in MySQL and run in
+# worker processes (BOT_MODE=worker); the bot itself only enqueues them on schedule
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))  # tasks one worker process runs at a time
+# Tasks the polling/webhook process also runs itself; 0 leaves them all to the workers
+BOT_EMBEDDED_WORKERS = int(os.getenv("BOT_EMBEDDED_WORKERS", "0"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "5"))
+# A claimed task is handed to another worker if its worker stops extending it for this long
+TASK_VISIBILITY_TIMEOUT = float(os.getenv("TASK_VISIBILITY_TIMEOUT", "300"))
+TASK_POLL_INTERVAL = float(os.getenv("TASK_POLL_INTERVAL", "2"))  # seconds between claims while the queue is empty
+TASK_RETRY_DELAY = float(os.getenv("TASK_RETRY_DELAY", "30"))  # seconds before the first retry, doubles per attempt
+
+# The morning prompt is spread over this many minutes after MORNING_TIME: every user has a fixed
+# delivery slot derived from their user_id, and a tick every MORNING_TICK_SECONDS sends the slots
+# that have come due. 0 sends to everyone at once.
+MORNING_WINDOW_MINUTES = int(os.getenv("MORNING_WINDOW_MINUTES", "60"))
+MORNING_TICK_SECONDS = int(os.getenv("MORNING_TICK_SECONDS", "60"))
+
+# Days of per-user broadcast checkpoints to keep; they are only needed to resume a broadcast
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "14"))
+
+# Prometheus metrics endpoint; set METRICS_PORT to 0 to disable
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# Port of BOT_MODE=worker processes, so a worker can run next to the bot on one host
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9101"))
+METRICS_POOL_REFRESH = float(os.getenv("METRICS_POOL_REFRESH", "60"))  # seconds between pool size GROUP BY refreshes
+
+# How updates reach the bot: "polling" (getUpdates) or "webhook" (Telegram pushes them to us),
+# or "worker" for a process that runs queued tasks and never sees updates
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# Public HTTPS URL Telegram posts to, e.g. "https://bot.example.com"; WEBHOOK_PATH is appended
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+# Sent by Telegram in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Simultaneous HTTPS connections Telegram may open to deliver updates (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Updates from different users are handled concurrently, at most UPDATE_CONCURRENCY at a time;
+# each user's own updates still run one at a time, in order
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+# Updates accepted for processing (running or queued) before fetching more waits
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "512"))
+UPDATE_QUEUE_WARN = int(os.getenv("UPDATE_QUEUE_WARN", "100"))  # log when more updates than this are waiting
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 cyprus_tz = pytz.timezone("Asia/Nicosia")
+MORNING_TIME = dt_time(hour=11, minute=0, second=0)
+
+# users.delivery_slot is CRC32(user_id) & 0xFFFF, so slots are spread evenly over [0, DELIVERY_SLOTS)
+DELIVERY_SLOTS = 0x10000
 
 # Example categories...
 wide_categories = {
@@ -62,6 +219,182 @@ wide_categories = {
 narrow_categories = ["Nature", "Abstract", "Animals", "Space", "Cities", "Fantasy", "Technology"]
 
 
+# -------------------------
+# METRICS
+# -------------------------
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric:
+    """A metric family in Prometheus text exposition format. Thread-safe."""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines += self._render_value(labels, value)
+        return lines
+
+    def _render_value(self, labels: tuple, value) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class GaugeMetric(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[tuple(sorted(labels.items()))] = value
+
+    def replace(self, values: Dict[tuple, float]):
+        """Swap in a complete new set of samples (label tuple -> value)."""
+        with self._lock:
+            self._values = dict(values)
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def _render_value(self, labels: tuple, value) -> List[str]:
+        lines = [
+            f"{self.name}_bucket{_format_labels(labels + (('le', bound),))} {count}"
+            for bound, count in zip(self.buckets, value["counts"])
+        ]
+        lines.append(f"{self.name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {value['sum']}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {value['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """`collect()` is called on every scrape to refresh gauges that are read rather than pushed."""
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        for collect in self._collectors:
+            try:
+                collect()
+            except Exception as e:
+                logger.error(f"Metrics collector {collect.__name__} failed: {e}")
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 300, 900, 1800, 3600, 7200)
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.register(HistogramMetric(
+    "bot_handler_duration_seconds", "Time spent in update handlers.", LATENCY_BUCKETS))
+JOB_SECONDS = metrics.register(HistogramMetric(
+    "bot_job_duration_seconds", "Time spent in scheduled jobs.", JOB_BUCKETS))
+DB_QUERY_SECONDS = metrics.register(HistogramMetric(
+    "bot_db_query_duration_seconds", "Time spent in MySQL round trips (statements, commits, pings).", LATENCY_BUCKETS))
+DB_POOL_CONNECTIONS = metrics.register(GaugeMetric(
+    "bot_db_pool_connections", "MySQL pool connections by state."))
+USER_CACHE_LOOKUPS = metrics.register(CounterMetric(
+    "bot_user_cache_lookups_total", "User cache lookups by result."))
+SEEN_INDEX_BYTES = metrics.register(GaugeMetric(
+    "bot_seen_index_bytes", "Approximate memory held by the seen-image index."))
+SEEN_INDEX_ENTRIES = metrics.register(GaugeMetric(
+    "bot_seen_index_entries", "Categories, per-user bitmaps and users held by the seen-image index."))
+UNSPLASH_REMAINING = metrics.register(GaugeMetric(
+    "bot_unsplash_ratelimit_remaining", "Last X-Ratelimit-Remaining reported by Unsplash."))
+UNSPLASH_LIMIT = metrics.register(GaugeMetric(
+    "bot_unsplash_ratelimit_limit", "Last X-Ratelimit-Limit reported by Unsplash."))
+UNSPLASH_FORBIDDEN = metrics.register(CounterMetric(
+    "bot_unsplash_forbidden_total", "Unsplash requests rejected with 403."))
+UNSPLASH_BREAKER_OPEN = metrics.register(GaugeMetric(
+    "bot_unsplash_breaker_open", "1 while the Unsplash circuit breaker refuses calls."))
+POOL_FALLBACKS = metrics.register(CounterMetric(
+    "bot_pool_fallbacks_total", "Wallpapers served from another category while Unsplash was unavailable, by result."))
+TELEGRAM_SEND_ERRORS = metrics.register(CounterMetric(
+    "bot_telegram_send_errors_total", "Telegram sends that failed, by reason."))
+TELEGRAM_SEND_RETRIES = metrics.register(CounterMetric(
+    "bot_telegram_send_retries_total", "Telegram sends that were retried, by reason."))
+BROADCAST_MESSAGES = metrics.register(CounterMetric(
+    "bot_broadcast_messages_total", "Broadcast messages handled, by broadcast kind and result."))
+BROADCAST_RATE = metrics.register(GaugeMetric(
+    "bot_broadcast_messages_per_second", "Send rate of the current or last run of each broadcast."))
+CATEGORY_POOL_IMAGES = metrics.register(GaugeMetric(
+    "bot_category_pool_images", "Images stored per category."))
+CLUSTER_LEADER = metrics.register(GaugeMetric(
+    "bot_cluster_leader", "1 if this instance holds the leader lease."))
+UPDATES_QUEUED = metrics.register(GaugeMetric(
+    "bot_updates_queued", "Updates waiting for a handler slot or for the same user's previous update."))
+UPDATES_RUNNING = metrics.register(GaugeMetric(
+    "bot_updates_running", "Updates being handled right now."))
+TASKS = metrics.register(CounterMetric(
+    "bot_tasks_total", "Queued tasks run by this process, by kind and result."))
+TASK_QUEUE_DEPTH = metrics.register(GaugeMetric(
+    "bot_task_queue_depth", "Tasks waiting or running in the queue, by kind and status."))
+
+
+def timed(histogram: HistogramMetric, **labels):
+    """Decorator recording how long an async handler or job takes."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+        return wrapper
+    return decorator
+
+
 def get_connection():
     try:
         conn = mysql.connector.connect(
@@ -71,60 +404,811 @@ def get_connection():
             password=DB_PASS,
             database=DB_NAME
         )
-        return conn
+        return CountingConnection(conn)
     except Error as e:
         logger.error(f"Error connecting to MySQL: {e}")
         raise
 
 
-def init_db():
-    try:
-        conn = get_connection()
-        c = conn.cursor()
-
-        c.execute("""
-         CREATE TABLE IF NOT EXISTS users (
-             user_id BIGINT PRIMARY KEY,
-             user_group VARCHAR(50) NOT NULL,
-             wallpapers_used INT NOT NULL DEFAULT 0,
-             wallpapers_received INT NOT NULL DEFAULT 0,
-             chosen_category VARCHAR(255),
-             last_category_click VARCHAR(50)
-         )
-         """)
+# -------------------------
+# CONNECTION POOL
+# -------------------------
+class ConnectionPool:
+    """
+    A small blocking pool of MySQL connections.
 
-        c.execute("""
-         CREATE TABLE IF NOT EXISTS images (
-             id INT PRIMARY KEY AUTO_INCREMENT,
-             category_key VARCHAR(255) NOT NULL,
-             image_id VARCHAR(100) NOT NULL,
-             image_url VARCHAR(255) NOT NULL
-         )
-         """)
+    Connections are created lazily up to `size`. When every connection is
+    checked out, callers wait up to `timeout` seconds for one to be returned.
+    Connections idle for longer than `ping_interval` are pinged (and
+    reconnected if the server dropped them) before being handed out.
+    """
 
+    def __init__(self, size: int, timeout: float, ping_interval: float):
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self._idle = queue.LifoQueue()  # (conn, returned_at); LIFO keeps hot connections hot
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+
+    def _acquire(self):
+        # Reuse an idle connection or open a new one while we are under the size limit
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return get_connection(), time.monotonic()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # Pool is saturated, wait for a connection to be released
+        logger.warning(f"DB pool saturated ({self.size} connections in use), waiting...")
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise Error(msg=f"Timed out after {self.timeout}s waiting for a DB connection")
+
+    def _check_health(self, conn, returned_at: float):
+        if time.monotonic() - returned_at < self.ping_interval:
+            return conn
+        try:
+            conn.ping(reconnect=True, attempts=2, delay=0)
+            return conn
+        except Error as e:
+            logger.warning(f"Stale DB connection dropped: {e}")
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return get_connection()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        started = time.monotonic()
+        conn, returned_at = self._acquire()
+        try:
+            conn = self._check_health(conn, returned_at)
+        except Exception:
+            self._discard(conn)
+            raise
+        waited = time.monotonic() - started
+        with self._lock:
+            self._in_use += 1
+            in_use = self._in_use
+        if waited > DB_POOL_WAIT_WARN:
+            logger.warning(f"Waited {waited * 1000:.0f} ms for a DB connection ({in_use}/{self.size} in use)")
+
+        healthy = True
+        try:
+            yield conn
+        except Error:
+            # The connection may be in an unknown state, do not hand it out again
+            healthy = False
+            raise
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            # No ping here: that would be a round trip per use; _check_health covers idle ones
+            if healthy:
+                self._idle.put((conn, time.monotonic()))
+            else:
+                self._discard(conn)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": self.size, "created": self._created, "in_use": self._in_use}
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_PING_INTERVAL)
+
+
+class QueryStats:
+    """Process-wide count and total time of round trips to MySQL (statements, commits, rollbacks, pings)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self.queries += 1
+            self.seconds += seconds
+        DB_QUERY_SECONDS.observe(seconds)
+
+
+db_stats = QueryStats()
+
+
+class CountingConnection:
+    """Wraps a mysql-connector connection and records commit/rollback/ping round trips in db_stats."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def _timed(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            db_stats.record(time.perf_counter() - started)
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._conn.cursor(*args, **kwargs))
+
+    def commit(self):
+        return self._timed(self._conn.commit)
+
+    def rollback(self):
+        return self._timed(self._conn.rollback)
+
+    def ping(self, *args, **kwargs):
+        return self._timed(self._conn.ping, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingCursor:
+    """Wraps a mysql-connector cursor and records every execute/executemany in db_stats."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            db_stats.record(time.perf_counter() - started)
+
+    def executemany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        finally:
+            db_stats.record(time.perf_counter() - started)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+@contextmanager
+def db_cursor(dictionary: bool = False):
+    """
+    Borrow a pooled connection and yield a cursor on it.
+    Commits when the block finishes, rolls back if it raises.
+    """
+    with db_pool.connection() as conn:
+        c = conn.cursor(dictionary=dictionary)
+        try:
+            yield c
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+# -------------------------
+# USER CACHE
+# -------------------------
+class UserCache:
+    """
+    Bounded LRU of user records with a TTL.
+
+    get_or_create_user reads through it and every function that writes a
+    users row updates or invalidates the cached copy, so the cache never
+    serves a value older than our own last write. The TTL bounds staleness
+    for changes made outside this process, so nothing that must hold across
+    instances (like the daily limit) is decided from it. Records are copied
+    in and out, so handlers can mutate what they get back. Thread-safe,
+    since the data functions run on the DB executor.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (expires_at, record)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                USER_CACHE_LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            USER_CACHE_LOOKUPS.inc(result="hit")
+            return dict(entry[1])
+
+    def put(self, user: Dict[str, Any]):
+        with self._lock:
+            self._entries[user["user_id"]] = (time.monotonic() + self.ttl, dict(user))
+            self._entries.move_to_end(user["user_id"])
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def patch(self, user_id: int, **fields):
+        """Apply a write to the cached record, if there is one."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def bump(self, user_id: int, field: str, amount: int):
+        """Apply a counter increment to the cached record, if there is one."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1][field] += amount
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+
+# -------------------------
+# SEEN INDEX
+# -------------------------
+class SeenIndex:
+    """
+    In-process index answering "first unseen image in this category for this
+    user" without an anti-join in MySQL.
+
+    Each loaded category keeps its photo pks in ascending order in an array;
+    a photo's position in it is its ordinal. Each (user, category) pair keeps
+    a bitmap (a Python int) of the ordinals the user has seen. Both are loaded
+    lazily and kept current as images are added, reserved, released and marked
+    as used. Photos normally join a category with a higher pk than any before,
+    so they are appended and ordinals never move; when that is not the case the
+    category is dropped and reloaded. Bitmaps are evicted least recently used
+    once the index holds more than `max_bytes`.
+
+    MySQL stays authoritative: a claim in user_photos can still fail (another
+    instance served the image), and an exhausted category is double-checked
+    with a query, so a stale index costs a retry, never a wrong answer.
+    """
+
+    # Rough per-bitmap cost of the dict slot, key tuple and user_categories entry
+    ENTRY_OVERHEAD = 160
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._categories: Dict[int, array] = {}
+        self._bitmaps: "OrderedDict[tuple, int]" = OrderedDict()
+        self._user_categories: Dict[int, set] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @staticmethod
+    def _ordinal(photos: array, photo_pk: int) -> Optional[int]:
+        i = bisect_left(photos, photo_pk)
+        return i if i < len(photos) and photos[i] == photo_pk else None
+
+    def _set_bitmap(self, key: tuple, bitmap: Optional[int]):
+        old = self._bitmaps.pop(key, None)
+        if old is not None:
+            self._bytes -= sys.getsizeof(old) + self.ENTRY_OVERHEAD
+            if bitmap is None:
+                categories = self._user_categories.get(key[0])
+                categories.discard(key[1])
+                if not categories:
+                    del self._user_categories[key[0]]
+        if bitmap is None:
+            return
+        self._bitmaps[key] = bitmap
+        self._user_categories.setdefault(key[0], set()).add(key[1])
+        self._bytes += sys.getsizeof(bitmap) + self.ENTRY_OVERHEAD
+        while self._bytes > self.max_bytes and self._bitmaps:
+            self._set_bitmap(next(iter(self._bitmaps)), None)
+            self.evictions += 1
+
+    def _category(self, c, category_id: int) -> array:
+        with self._lock:
+            photos = self._categories.get(category_id)
+        if photos is not None:
+            return photos
+        c.execute("SELECT photo_pk FROM photo_categories WHERE category_id = %s ORDER BY photo_pk", (category_id,))
+        photos = array("I", (r["photo_pk"] for r in c.fetchall()))
+        with self._lock:
+            if category_id not in self._categories:
+                self._categories[category_id] = photos
+                self._bytes += sys.getsizeof(photos)
+            return self._categories[category_id]
+
+    def _bitmap(self, c, category_id: int, user_id: int, photos: array) -> int:
+        key = (user_id, category_id)
+        with self._lock:
+            bitmap = self._bitmaps.get(key)
+            if bitmap is not None:
+                self._bitmaps.move_to_end(key)
+                self.hits += 1
+                return bitmap
+            self.misses += 1
         c.execute("""
-         CREATE TABLE IF NOT EXISTS user_images (
-             id INT PRIMARY KEY AUTO_INCREMENT,
-             user_id BIGINT NOT NULL,
-             image_id VARCHAR(100) NOT NULL,
-             UNIQUE KEY unique_user_image (user_id, image_id)
-         )
-         """)
+             SELECT up.photo_pk
+               FROM user_photos up
+               JOIN photo_categories pc ON pc.photo_pk = up.photo_pk AND pc.category_id = %s
+              WHERE up.user_id = %s
+         """, (category_id, user_id))
+        bitmap = 0
+        for r in c.fetchall():
+            i = self._ordinal(photos, r["photo_pk"])
+            if i is not None:
+                bitmap |= 1 << i
+        with self._lock:
+            if self._categories.get(category_id) is photos:
+                self._set_bitmap(key, bitmap)
+        return bitmap
+
+    def next_unseen(self, c, category_id: int, user_id: int, order: str, exclude=()) -> Optional[int]:
+        """The pk of the next photo in the category the user has not seen, or None. `c` must be a dictionary cursor."""
+        photos = self._category(c, category_id)
+        unseen = ((1 << len(photos)) - 1) & ~self._bitmap(c, category_id, user_id, photos)
+        for photo_pk in exclude:
+            i = self._ordinal(photos, photo_pk)
+            if i is not None:
+                unseen &= ~(1 << i)
+        if not unseen:
+            return None
+        if order == "newest":
+            i = unseen.bit_length() - 1
+        elif order == "random":
+            # First unseen at or after a random ordinal, wrapping around
+            start = random.randrange(len(photos))
+            later = unseen >> start
+            i = start + (later & -later).bit_length() - 1 if later else (unseen & -unseen).bit_length() - 1
+        else:
+            i = (unseen & -unseen).bit_length() - 1
+        return photos[i]
+
+    def extend_category(self, c, category_id: int) -> bool:
+        """Append photos added to a loaded category by someone else; True if there were any."""
+        with self._lock:
+            photos = self._categories.get(category_id)
+        if photos is None:
+            return False
+        c.execute("""
+             SELECT photo_pk FROM photo_categories
+              WHERE category_id = %s AND photo_pk > %s
+           ORDER BY photo_pk
+         """, (category_id, photos[-1] if photos else 0))
+        return self.add_photos(category_id, [r["photo_pk"] for r in c.fetchall()]) > 0
+
+    def add_photos(self, category_id: int, photo_pks: List[int]) -> int:
+        """Record photos linked to a category; returns how many were new to the index."""
+        added = 0
+        with self._lock:
+            photos = self._categories.get(category_id)
+            if photos is None:
+                return 0
+            size = sys.getsizeof(photos)
+            for photo_pk in sorted(photo_pks):
+                if not photos or photo_pk > photos[-1]:
+                    photos.append(photo_pk)
+                    added += 1
+                elif self._ordinal(photos, photo_pk) is None:
+                    # Would shift every later ordinal; reload the category instead
+                    self._bytes += sys.getsizeof(photos) - size
+                    self._drop_category(category_id)
+                    return added
+            self._bytes += sys.getsizeof(photos) - size
+        return added
+
+    def invalidate_category(self, category_id: int):
+        with self._lock:
+            self._drop_category(category_id)
+
+    def _drop_category(self, category_id: int):
+        photos = self._categories.pop(category_id, None)
+        if photos is None:
+            return
+        self._bytes -= sys.getsizeof(photos)
+        for key in [k for k in self._bitmaps if k[1] == category_id]:
+            self._set_bitmap(key, None)
+
+    def _update(self, user_id: int, photo_pk: int, seen: bool):
+        with self._lock:
+            for category_id in list(self._user_categories.get(user_id, ())):
+                key = (user_id, category_id)
+                bitmap = self._bitmaps.get(key)
+                if bitmap is None:
+                    continue  # evicted by an earlier update in this loop
+                i = self._ordinal(self._categories[category_id], photo_pk)
+                if i is not None:
+                    self._set_bitmap(key, bitmap | (1 << i) if seen else bitmap & ~(1 << i))
+
+    def mark_seen(self, user_id: int, photo_pk: int):
+        if self.enabled:
+            self._update(user_id, photo_pk, True)
+
+    def mark_unseen(self, user_id: int, photo_pk: int):
+        if self.enabled:
+            self._update(user_id, photo_pk, False)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            users = len(self._user_categories)
+            return {
+                "categories": len(self._categories),
+                "bitmaps": len(self._bitmaps),
+                "users": users,
+                "bytes": self._bytes,
+                "bytes_per_user": self._bytes // users if users else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+seen_index = SeenIndex(SEEN_INDEX_MAX_BYTES)
+
+
+def table_exists(c, table: str) -> bool:
+    c.execute("""
+         SELECT COUNT(*) FROM information_schema.tables
+          WHERE table_schema = DATABASE() AND table_name = %s
+     """, (table,))
+    return c.fetchone()[0] > 0
+
+
+def index_exists(c, table: str, name: str) -> bool:
+    c.execute("""
+         SELECT COUNT(*) FROM information_schema.statistics
+          WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+     """, (table, name))
+    return c.fetchone()[0] > 0
+
+
+def ensure_column(c, table: str, name: str, definition: str):
+    """Add a column unless it already exists."""
+    c.execute("""
+         SELECT COUNT(*) FROM information_schema.columns
+          WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+     """, (table, name))
+    if c.fetchone()[0] == 0:
+        logger.info(f"Adding column {name} to {table}")
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
 
-        conn.commit()
-        c.close()
-        conn.close()
+def ensure_index(c, table: str, name: str, columns: str, unique: bool = False):
+    """Add an index unless it already exists (MySQL has no ADD INDEX IF NOT EXISTS)."""
+    if not index_exists(c, table, name):
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        logger.info(f"Adding {kind.lower()} {name} on {table} ({columns})")
+        c.execute(f"ALTER TABLE {table} ADD {kind} {name} ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+
+
+def init_db():
+    try:
+        with db_cursor() as c:
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS users (
+                 user_id BIGINT PRIMARY KEY,
+                 user_group VARCHAR(50) NOT NULL,
+                 wallpapers_used INT NOT NULL DEFAULT 0,
+                 wallpapers_received INT NOT NULL DEFAULT 0,
+                 chosen_category VARCHAR(255),
+                 last_category_click VARCHAR(50),
+                 delivery_slot SMALLINT UNSIGNED
+             )
+             """)
+
+            # Photos are stored once, however many categories they appear in; categories and
+            # deliveries refer to them by small integer keys
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS categories (
+                 id SMALLINT UNSIGNED PRIMARY KEY AUTO_INCREMENT,
+                 category_key VARCHAR(255) NOT NULL,
+                 UNIQUE KEY unique_category_key (category_key)
+             )
+             """)
+
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS photos (
+                 id INT UNSIGNED PRIMARY KEY AUTO_INCREMENT,
+                 image_id VARCHAR(100) NOT NULL,
+                 image_url VARCHAR(255) NOT NULL,
+                 tg_photo_file_id VARCHAR(255),
+                 tg_document_file_id VARCHAR(255),
+                 content_sha256 CHAR(64),
+                 UNIQUE KEY unique_image_id (image_id)
+             )
+             """)
+
+            # Clustered on (category, photo), so "next unseen image" walks the category in photo order
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS photo_categories (
+                 category_id SMALLINT UNSIGNED NOT NULL,
+                 photo_pk INT UNSIGNED NOT NULL,
+                 PRIMARY KEY (category_id, photo_pk)
+             )
+             """)
+
+            # Photos each user has received; user_id stays BIGINT, Telegram ids do not fit an INT
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS user_photos (
+                 user_id BIGINT NOT NULL,
+                 photo_pk INT UNSIGNED NOT NULL,
+                 PRIMARY KEY (user_id, photo_pk)
+             )
+             """)
+
+            # Position of the user within the morning delivery window
+            ensure_column(c, "users", "delivery_slot", "SMALLINT UNSIGNED")
+            # Broadcast pages walk it in (delivery_slot, user_id) order, reading only their slot range
+            ensure_index(c, "users", "idx_users_slot_user", "delivery_slot, user_id")
+            if index_exists(c, "users", "idx_users_delivery_slot"):
+                c.execute("ALTER TABLE users DROP INDEX idx_users_delivery_slot, ALGORITHM=INPLACE, LOCK=NONE")
+
+            # Per-day, per-group counters, incremented as events happen so the daily summary never scans users
+            create_stats = not table_exists(c, "daily_stats")
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS daily_stats (
+                 day DATE NOT NULL,
+                 user_group VARCHAR(50) NOT NULL,
+                 wallpapers_received INT NOT NULL DEFAULT 0,
+                 wallpapers_used INT NOT NULL DEFAULT 0,
+                 usage_replies INT NOT NULL DEFAULT 0,
+                 PRIMARY KEY (day, user_group)
+             )
+             """)
+            if create_stats:
+                # Carry the lifetime totals over so they stay correct after the switch
+                c.execute("""
+                 INSERT INTO daily_stats (day, user_group, wallpapers_received, wallpapers_used)
+                 SELECT %s, user_group, SUM(wallpapers_received), SUM(wallpapers_used)
+                   FROM users
+               GROUP BY user_group
+                 """, (STATS_BASELINE_DAY,))
+
+            # One row per user handled by a broadcast, so an interrupted broadcast can resume without duplicates
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                 broadcast_id VARCHAR(100) NOT NULL,
+                 user_id BIGINT NOT NULL,
+                 delivered BOOLEAN NOT NULL,
+                 handled_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                 PRIMARY KEY (broadcast_id, user_id)
+             )
+             """)
+
+            # Small key/value store for state that must survive restarts (rate limits, job progress)
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS bot_state (
+                 name VARCHAR(100) PRIMARY KEY,
+                 value TEXT NOT NULL,
+                 updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+             )
+             """)
+
+            # Expiring leases held by one instance at a time (leader election, one-off reports)
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS leases (
+                 name VARCHAR(150) PRIMARY KEY,
+                 holder VARCHAR(100) NOT NULL,
+                 expires_at DATETIME(3) NOT NULL
+             )
+             """)
+
+            # Slot range shards of each broadcast and the worker currently sending each one
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS broadcast_shards (
+                 broadcast_id VARCHAR(100) NOT NULL,
+                 shard SMALLINT NOT NULL,
+                 holder VARCHAR(100) NULL,
+                 expires_at DATETIME(3) NULL,
+                 finished BOOLEAN NOT NULL DEFAULT FALSE,
+                 PRIMARY KEY (broadcast_id, shard)
+             )
+             """)
+
+            # Durable queue of batch jobs for the workers; for a running task available_at is
+            # the visibility deadline, after which another worker may take it over
+            c.execute("""
+             CREATE TABLE IF NOT EXISTS tasks (
+                 id BIGINT UNSIGNED PRIMARY KEY AUTO_INCREMENT,
+                 kind VARCHAR(50) NOT NULL,
+                 payload TEXT,
+                 dedupe_key VARCHAR(150) NULL,
+                 status VARCHAR(10) NOT NULL DEFAULT 'queued',
+                 attempts INT NOT NULL DEFAULT 0,
+                 available_at DATETIME(3) NOT NULL,
+                 claimed_by VARCHAR(100) NULL,
+                 last_error TEXT NULL,
+                 created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                 updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                 UNIQUE KEY unique_task_dedupe (dedupe_key),
+                 KEY idx_tasks_claim (status, available_at)
+             )
+             """)
+
+        migrate_legacy_images()
+        backfill_delivery_slots()
         logger.info("Database initialised (MySQL).")
     except Exception as e:
         logger.error(f"init_db error: {e}")
         raise
 
 
-def get_or_create_user(user_id: int) -> Dict[str, Any]:
-    conn = get_connection()
-    c = None
+SCHEMA_MIGRATION_STATE_NAME = "schema_migration:photos"
+# Processes starting together (bot and workers) wait this long for the one migrating the schema
+SCHEMA_MIGRATION_LOCK_TIMEOUT = 3600
+
+
+def migrate_legacy_images(batch_size: int = 5000):
+    """
+    Copy the old per-category images and user_images tables into photos,
+    photo_categories and user_photos, then rename them to *_legacy.
+
+    Runs in id-range batches of one short transaction each, so the copy
+    never holds long locks, and records its progress in bot_state so an
+    interrupted migration carries on where it stopped. Reruns are harmless:
+    every copy is an INSERT IGNORE keyed on the new unique keys.
+
+    Old instances may keep writing to the old tables during the copy, so
+    after the swap the rows they added are copied from the *_legacy tables,
+    which nothing writes to any more. Only one process migrates at a time
+    (GET_LOCK); the others wait and then find nothing left to do.
+    """
+    # Not from the pool: the migration itself borrows pool connections while the lock is held
+    lock_conn = get_connection()
     try:
-        c = conn.cursor(dictionary=True)
+        lock = lock_conn.cursor()
+        lock.execute("SELECT GET_LOCK('schema_migration', %s)", (SCHEMA_MIGRATION_LOCK_TIMEOUT,))
+        if lock.fetchone()[0] != 1:
+            raise Error(msg="Timed out waiting for another process's schema migration")
+        try:
+            _migrate_legacy_images(batch_size)
+        finally:
+            lock.execute("SELECT RELEASE_LOCK('schema_migration')")
+            lock.fetchall()
+            lock.close()
+    finally:
+        lock_conn.close()
+
+
+def _migrate_legacy_images(batch_size: int):
+    progress = load_state(SCHEMA_MIGRATION_STATE_NAME) or {"images": 0, "user_images": 0}
+    if progress.get("done"):
+        return
+    with db_cursor() as c:
+        if table_exists(c, "images"):
+            # Deployments that predate these columns
+            ensure_column(c, "images", "tg_photo_file_id", "VARCHAR(255)")
+            ensure_column(c, "images", "tg_document_file_id", "VARCHAR(255)")
+            ensure_column(c, "images", "content_sha256", "CHAR(64)")
+            swapped = False
+        elif table_exists(c, "images_legacy"):
+            # Swapped already, possibly without copying what was written just before it
+            swapped = True
+        else:
+            return
+
+    if not swapped:
+        _copy_legacy_images("images", "user_images", progress, batch_size)
+        with db_cursor() as c:
+            # Atomic swap; from here on old instances get errors instead of writing rows we would miss
+            c.execute("RENAME TABLE images TO images_legacy, user_images TO user_images_legacy")
+    _copy_legacy_images("images_legacy", "user_images_legacy", progress, batch_size)
+    progress["done"] = True
+    save_state(SCHEMA_MIGRATION_STATE_NAME, progress)
+    logger.info("Migrated images to photos; images_legacy and user_images_legacy can be dropped")
+
+
+def _copy_legacy_images(images: str, user_images: str, progress: Dict[str, int], batch_size: int):
+    """Copy the rows of `images`/`user_images` past `progress`, saving it after every batch."""
+    with db_cursor() as c:
+        c.execute(f"INSERT IGNORE INTO categories (category_key) SELECT DISTINCT category_key FROM {images}")
+        c.execute(f"SELECT COALESCE(MAX(id), 0) FROM {images}")
+        images_max = c.fetchone()[0]
+        c.execute(f"SELECT COALESCE(MAX(id), 0) FROM {user_images}")
+        user_images_max = c.fetchone()[0]
+    logger.info(f"Migrating {images} to photos from id {progress['images']} of {images_max}, "
+                f"{user_images} from id {progress['user_images']} of {user_images_max}")
+
+    # Photos in images.id order, so photo_pk keeps the old oldest/newest order
+    while progress["images"] < images_max:
+        low, high = progress["images"], min(images_max, progress["images"] + batch_size)
+        with db_cursor() as c:
+            c.execute(f"""
+                 INSERT INTO photos (image_id, image_url, tg_photo_file_id, tg_document_file_id, content_sha256)
+                 SELECT image_id, image_url, tg_photo_file_id, tg_document_file_id, content_sha256
+                   FROM {images}
+                  WHERE id > %s AND id <= %s
+               ORDER BY id
+                 ON DUPLICATE KEY UPDATE
+                     tg_photo_file_id = COALESCE(photos.tg_photo_file_id, VALUES(tg_photo_file_id)),
+                     tg_document_file_id = COALESCE(photos.tg_document_file_id, VALUES(tg_document_file_id)),
+                     content_sha256 = COALESCE(photos.content_sha256, VALUES(content_sha256))
+             """, (low, high))
+            c.execute(f"""
+                 INSERT IGNORE INTO photo_categories (category_id, photo_pk)
+                 SELECT cat.id, p.id
+                   FROM {images} i
+                   JOIN categories cat ON cat.category_key = i.category_key
+                   JOIN photos p ON p.image_id = i.image_id
+                  WHERE i.id > %s AND i.id <= %s
+             """, (low, high))
+        progress["images"] = high
+        save_state(SCHEMA_MIGRATION_STATE_NAME, progress)
+
+    while progress["user_images"] < user_images_max:
+        low, high = progress["user_images"], min(user_images_max, progress["user_images"] + batch_size)
+        with db_cursor() as c:
+            c.execute(f"""
+                 INSERT IGNORE INTO user_photos (user_id, photo_pk)
+                 SELECT ui.user_id, p.id
+                   FROM {user_images} ui
+                   JOIN photos p ON p.image_id = ui.image_id
+                  WHERE ui.id > %s AND ui.id <= %s
+             """, (low, high))
+        progress["user_images"] = high
+        save_state(SCHEMA_MIGRATION_STATE_NAME, progress)
+
+
+def backfill_delivery_slots(batch_size: int = 5000):
+    """Give users created before delivery slots existed their slot, in small batches to keep locks short."""
+    while True:
+        with db_cursor() as c:
+            c.execute("""
+                 UPDATE users SET delivery_slot = CRC32(user_id) & 0xFFFF
+                  WHERE delivery_slot IS NULL
+                  LIMIT %s
+             """, (batch_size,))
+            updated = c.rowcount
+        if updated:
+            logger.info(f"Assigned delivery slots to {updated} users")
+        if updated < batch_size:
+            return
+
+
+def get_or_create_user(user_id: int) -> Dict[str, Any]:
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        return cached
+    with db_cursor(dictionary=True) as c:
         c.execute("""
              SELECT user_id, user_group, wallpapers_used, wallpapers_received, chosen_category, last_category_click
              FROM users
@@ -132,7 +1216,7 @@ def get_or_create_user(user_id: int) -> Dict[str, Any]:
          """, (user_id,))
         row = c.fetchone()
         if row:
-            return {
+            user = {
                 "user_id": row["user_id"],
                 "group": row["user_group"],
                 "wallpapers_used": row["wallpapers_used"],
@@ -143,11 +1227,10 @@ def get_or_create_user(user_id: int) -> Dict[str, Any]:
         else:
             group = random.choice(["narrow", "wide"])
             c.execute("""
-                 INSERT INTO users (user_id, user_group)
-                 VALUES (%s, %s)
-             """, (user_id, group))
-            conn.commit()
-            return {
+                 INSERT INTO users (user_id, user_group, delivery_slot)
+                 VALUES (%s, %s, CRC32(%s) & 0xFFFF)
+             """, (user_id, group, user_id))
+            user = {
                 "user_id": user_id,
                 "group": group,
                 "wallpapers_used": 0,
@@ -155,171 +1238,1642 @@ def get_or_create_user(user_id: int) -> Dict[str, Any]:
                 "chosen_category": None,
                 "last_category_click": ""
             }
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+    user_cache.put(user)
+    return dict(user)
 
 
 def update_user(user: Dict[str, Any]):
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor()
+    """Persist the user's settings. Counters are never written here, they only change through the write buffer."""
+    with db_cursor() as c:
         c.execute("""
              UPDATE users
              SET user_group = %s,
-                 wallpapers_used = %s,
-                 wallpapers_received = %s,
                  chosen_category = %s
              WHERE user_id = %s
          """, (
             user["group"],
-            user["wallpapers_used"],
-            user["wallpapers_received"],
             user["chosen_category"],
             user["user_id"]
         ))
-        conn.commit()
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+    # Write-through; only the columns written above, a concurrent click update must not be undone
+    user_cache.patch(user["user_id"], group=user["group"], chosen_category=user["chosen_category"])
+
+
+# category_key -> categories.id; categories are only ever added, so ids can be cached for good
+_category_ids: Dict[str, int] = {}
+_category_ids_lock = threading.Lock()
+
+
+def get_category_id(c, category_key: str, create: bool = False) -> Optional[int]:
+    """The id of a category, inserting it first if `create`; None if it does not exist."""
+    category_id = _category_ids.get(category_key)
+    if category_id is not None:
+        return category_id
+    if create:
+        c.execute("INSERT IGNORE INTO categories (category_key) VALUES (%s)", (category_key,))
+    c.execute("SELECT id FROM categories WHERE category_key = %s", (category_key,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    category_id = row["id"] if isinstance(row, dict) else row[0]
+    with _category_ids_lock:
+        _category_ids[category_key] = category_id
+    return category_id
+
+
+# ORDER BY clauses for picking the next unseen image in a category
+IMAGE_ORDERS = {
+    "oldest": "pc.photo_pk ASC",
+    "newest": "pc.photo_pk DESC",
+    "random": "RAND()",
+}
 
 
-def fetch_images_from_db(category_key: str, user_id: int) -> List[Dict[str, str]]:
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor(dictionary=True)
-        c.execute("""
-         SELECT i.id, i.image_id, i.image_url
-           FROM images i
-      LEFT JOIN user_images ui
-             ON i.image_id = ui.image_id
-            AND ui.user_id = %s
-          WHERE i.category_key = %s
-            AND ui.image_id IS NULL
-         """, (user_id, category_key))
-        rows = c.fetchall()
-        return [{
-            "db_id": r["id"],
-            "image_id": r["image_id"],
-            "image_url": r["image_url"]
-        } for r in rows]
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+def select_next_image(c, category_key: str, user_id: int, order: str = None, exclude=(),
+                      use_index: bool = True) -> Optional[Dict[str, Any]]:
+    """
+    The next image in the category the user has not seen yet, or None.
+    Walks the category's photo_categories range in primary key order and probes
+    user_photos' primary key per candidate, stopping at the first hit.
+    `c` must be a dictionary cursor; photo pks in `exclude` are skipped.
+    Without `use_index` the seen index is bypassed and MySQL answers.
+    """
+    category_id = get_category_id(c, category_key)
+    if category_id is None:
+        return None
+    order = order or IMAGE_ORDER
+    if use_index and seen_index.enabled:
+        photo_pk = seen_index.next_unseen(c, category_id, user_id, order, exclude)
+        if photo_pk is None and seen_index.extend_category(c, category_id):
+            photo_pk = seen_index.next_unseen(c, category_id, user_id, order, exclude)
+        if photo_pk is not None:
+            c.execute("""
+                 SELECT p.id, p.image_id, p.image_url, p.tg_photo_file_id, p.tg_document_file_id, p.content_sha256
+                   FROM photos p
+                  WHERE p.id = %s
+             """, (photo_pk,))
+            return image_from_row(c.fetchone())
+        # The index says the user has seen everything; make sure with MySQL below
+    order_by = IMAGE_ORDERS[order]
+    exclude_sql = f"AND pc.photo_pk NOT IN ({', '.join(['%s'] * len(exclude))})" if exclude else ""
+    c.execute(f"""
+     SELECT p.id, p.image_id, p.image_url, p.tg_photo_file_id, p.tg_document_file_id, p.content_sha256
+       FROM photo_categories pc
+       JOIN photos p ON p.id = pc.photo_pk
+      WHERE pc.category_id = %s
+        AND NOT EXISTS (
+            SELECT 1 FROM user_photos up
+             WHERE up.user_id = %s AND up.photo_pk = pc.photo_pk
+        )
+        {exclude_sql}
+   ORDER BY {order_by}
+      LIMIT 1
+     """, (category_id, user_id, *exclude))
+    r = c.fetchone()
+    if r is None:
+        return None
+    if seen_index.enabled:
+        # The index missed this one (linked to the category out of order, or released by
+        # another instance); reload the category and its bitmaps when next used
+        seen_index.invalidate_category(category_id)
+    return image_from_row(r)
+
+
+def image_from_row(r: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "db_id": r["id"],
+        "image_id": r["image_id"],
+        "image_url": r["image_url"],
+        "photo_file_id": r["tg_photo_file_id"],
+        "document_file_id": r["tg_document_file_id"],
+        "content_sha256": r["content_sha256"]
+    }
 
 
-def add_images_to_db(category_key: str, images: List[Dict[str, str]]):
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor()
-        for img in images:
+def reserve_next_image(user: Dict[str, Any], category_key: str, order: str = None) -> Optional[Dict[str, Any]]:
+    """
+    Atomically claim the next unseen image in the category for the user.
+
+    In one transaction the image is inserted into user_photos (the primary key
+    makes a concurrent claim of the same image by another tap or another bot
+    instance fail) and wallpapers_received is bumped; today's daily_stats row
+    is shared by every delivery, so that goes through the write buffer instead
+    (see reserve_next_image_async).
+    If someone else claimed the candidate first, the next one is tried; the
+    last attempt asks MySQL directly, in case the seen index is stale for
+    this user (another instance delivered the photos it keeps offering).
+    Returns the claimed image, or None if the category has nothing left for the user.
+    """
+    user_id = user["user_id"]
+    tried = []
+    with db_cursor(dictionary=True) as c:
+        for attempt in range(RESERVE_MAX_ATTEMPTS):
+            img = select_next_image(c, category_key, user_id, order, exclude=tried,
+                                    use_index=attempt < RESERVE_MAX_ATTEMPTS - 1)
+            if img is None:
+                return None
             c.execute("""
-                 INSERT INTO images (category_key, image_id, image_url)
-                 VALUES (%s, %s, %s)
-             """, (category_key, img["id"], img["url"]))
-        conn.commit()
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+                 INSERT IGNORE INTO user_photos (user_id, photo_pk)
+                 VALUES (%s, %s)
+             """, (user_id, img["db_id"]))
+            if c.rowcount == 1:
+                c.execute("""
+                     UPDATE users SET wallpapers_received = wallpapers_received + 1 WHERE user_id = %s
+                 """, (user_id,))
+                break
+            # Already the user's; the index (if any) did not know yet
+            seen_index.mark_seen(user_id, img["db_id"])
+            tried.append(img["db_id"])
+        else:
+            return None
+    user_cache.bump(user_id, "wallpapers_received", 1)
+    seen_index.mark_seen(user_id, img["db_id"])
+    return img
+
+
+def release_image(user: Dict[str, Any], photo_pk: int) -> bool:
+    """Undo reserve_next_image after the image could not be delivered. Returns False if it was not reserved."""
+    user_id = user["user_id"]
+    with db_cursor() as c:
+        c.execute("DELETE FROM user_photos WHERE user_id = %s AND photo_pk = %s", (user_id, photo_pk))
+        if c.rowcount == 0:
+            return False
+        c.execute("""
+             UPDATE users SET wallpapers_received = wallpapers_received - 1 WHERE user_id = %s
+         """, (user_id,))
+    user_cache.bump(user_id, "wallpapers_received", -1)
+    seen_index.mark_unseen(user_id, photo_pk)
+    return True
 
 
-def mark_image_as_used(user_id: int, image_id: str):
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor()
+def store_image_file_ids(photo_pk: int, photo_file_id: Optional[str], document_file_id: Optional[str]):
+    """Remember Telegram's file_ids for a photo, shared by every category it is in."""
+    with db_cursor() as c:
         c.execute("""
-             INSERT IGNORE INTO user_images (user_id, image_id)
+             UPDATE photos
+                SET tg_photo_file_id = COALESCE(%s, tg_photo_file_id),
+                    tg_document_file_id = COALESCE(%s, tg_document_file_id)
+              WHERE id = %s
+         """, (photo_file_id, document_file_id, photo_pk))
+
+
+def add_images_to_db(category_key: str, images: List[Dict[str, str]]) -> int:
+    """
+    Insert images in one batch: photos we do not have yet are added to photos,
+    and all of them are linked to the category. Returns how many were new to the category.
+    """
+    if not images:
+        return 0
+    with db_cursor() as c:
+        category_id = get_category_id(c, category_key, create=True)
+        c.executemany("""
+             INSERT IGNORE INTO photos (image_id, image_url)
              VALUES (%s, %s)
-         """, (user_id, image_id))
-        conn.commit()
+         """, [(img["id"], img["url"]) for img in images])
+        c.execute(f"SELECT id FROM photos WHERE image_id IN ({', '.join(['%s'] * len(images))})",
+                  tuple(img["id"] for img in images))
+        photo_pks = [row[0] for row in c.fetchall()]
+        c.executemany("""
+             INSERT IGNORE INTO photo_categories (category_id, photo_pk)
+             VALUES (%s, %s)
+         """, [(category_id, photo_pk) for photo_pk in photo_pks])
+        added = c.rowcount
+    seen_index.add_photos(category_id, photo_pks)
+    return added
+
+
+def fetch_images_without_content(limit: int) -> List[Dict[str, Any]]:
+    """Photos that have no copy in the local image store yet, newest first."""
+    with db_cursor(dictionary=True) as c:
+        c.execute("""
+             SELECT image_id, image_url
+               FROM photos
+              WHERE content_sha256 IS NULL
+           ORDER BY id DESC
+              LIMIT %s
+         """, (limit,))
+        return c.fetchall()
+
+
+def fetch_category_inventory(active_since: str) -> Dict[str, Dict[str, int]]:
+    """
+    Per category: how many images it has (stock), how many users picked it since
+    `active_since` (an ISO timestamp), and how many of its images those users have seen in total.
+    """
+    inventory = {}
+    with db_cursor(dictionary=True) as c:
+        c.execute("""
+             SELECT cat.category_key, COUNT(*) AS stock
+               FROM photo_categories pc
+               JOIN categories cat ON cat.id = pc.category_id
+           GROUP BY cat.category_key
+         """)
+        for r in c.fetchall():
+            inventory[r["category_key"]] = {"stock": r["stock"], "active_users": 0, "seen_total": 0}
+        c.execute("""
+             SELECT u.chosen_category AS category_key,
+                    COUNT(DISTINCT u.user_id) AS active_users,
+                    COUNT(pc.photo_pk) AS seen_total
+               FROM users u
+          LEFT JOIN categories cat ON cat.category_key = u.chosen_category
+          LEFT JOIN user_photos up ON up.user_id = u.user_id
+          LEFT JOIN photo_categories pc ON pc.category_id = cat.id AND pc.photo_pk = up.photo_pk
+              WHERE u.chosen_category IS NOT NULL
+                AND u.last_category_click >= %s
+           GROUP BY u.chosen_category
+         """, (active_since,))
+        for r in c.fetchall():
+            inv = inventory.setdefault(r["category_key"], {"stock": 0, "active_users": 0, "seen_total": 0})
+            inv["active_users"] = r["active_users"]
+            inv["seen_total"] = r["seen_total"]
+    return inventory
+
+
+def store_image_content_hash(image_id: str, sha256: str):
+    with db_cursor() as c:
+        c.execute("UPDATE photos SET content_sha256 = %s WHERE image_id = %s", (sha256, image_id))
+
+
+def claim_category_click(user_id: int) -> bool:
+    """
+    Record a category choice unless the user already made one in the last
+    12 hours; returns whether it was recorded. The check is done by the
+    UPDATE itself, so it holds across instances whatever their caches say.
+    """
+    now = datetime.now()
+    clicked_at = now.isoformat()
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE users
+                SET last_category_click = %s
+              WHERE user_id = %s
+                AND (last_category_click IS NULL OR last_category_click < %s)
+         """, (clicked_at, user_id, (now - timedelta(hours=12)).isoformat()))
+        claimed = c.rowcount > 0
+    if claimed:
+        user_cache.patch(user_id, last_category_click=clicked_at)
+    else:
+        # Our copy may predate a click handled by another instance
+        user_cache.invalidate(user_id)
+    return claimed
+
+
+# Extra WHERE conditions selecting who receives each kind of broadcast
+BROADCAST_AUDIENCES = {
+    "all": "",
+    "received": "AND u.wallpapers_received > 0",
+}
+
+
+def fetch_broadcast_page(broadcast_id: str, audience: str, after: tuple, limit: int,
+                         slots: tuple = (0, DELIVERY_SLOTS)) -> List[Dict[str, Any]]:
+    """
+    Next page of users with a delivery slot in [lo, hi) that have not been
+    handled in this broadcast, in (delivery_slot, user_id) order after
+    `after`, a (delivery_slot, user_id) pair; start from (lo, 0). The walk
+    is a range scan of idx_users_slot_user covering only these slots.
+    """
+    after_slot, after_user_id = after
+    with db_cursor(dictionary=True) as c:
+        c.execute(f"""
+             SELECT u.user_id, u.user_group, u.delivery_slot
+               FROM users u
+              WHERE (u.delivery_slot > %s OR (u.delivery_slot = %s AND u.user_id > %s))
+                AND u.delivery_slot < %s
+                {BROADCAST_AUDIENCES[audience]}
+                AND NOT EXISTS (
+                    SELECT 1 FROM broadcast_deliveries d
+                     WHERE d.broadcast_id = %s AND d.user_id = u.user_id
+                )
+           ORDER BY u.delivery_slot, u.user_id
+              LIMIT %s
+         """, (after_slot, after_slot, after_user_id, slots[1], broadcast_id, limit))
+        return c.fetchall()
+
+
+def shard_slots(slots: tuple, shard: int, shards: int) -> tuple:
+    """The part [lo, hi) of a slot range that one of its `shards` shards sends."""
+    lo, hi = slots
+    return lo + shard * (hi - lo) // shards, lo + (shard + 1) * (hi - lo) // shards
+
+
+def record_broadcast_delivery(broadcast_id: str, user_id: int, delivered: bool):
+    with db_cursor() as c:
+        c.execute("""
+             INSERT IGNORE INTO broadcast_deliveries (broadcast_id, user_id, delivered)
+             VALUES (%s, %s, %s)
+         """, (broadcast_id, user_id, delivered))
+
+
+def acquire_lease(name: str, holder: str, ttl: float) -> bool:
+    """Take the lease if it is free or expired, or extend it if `holder` already has it."""
+    with db_cursor() as c:
+        # Assignments run left to right: holder only changes if the lease has expired,
+        # then expires_at is only pushed out if the (possibly new) holder is us.
+        c.execute("""
+             INSERT INTO leases (name, holder, expires_at)
+             VALUES (%s, %s, NOW(3) + INTERVAL %s MICROSECOND)
+             ON DUPLICATE KEY UPDATE
+                 holder = IF(expires_at < NOW(3), VALUES(holder), holder),
+                 expires_at = IF(holder = VALUES(holder), VALUES(expires_at), expires_at)
+         """, (name, holder, int(ttl * 1_000_000)))
+        c.execute("SELECT holder FROM leases WHERE name = %s", (name,))
+        return c.fetchone()[0] == holder
+
+
+def release_lease(name: str, holder: str):
+    with db_cursor() as c:
+        c.execute("DELETE FROM leases WHERE name = %s AND holder = %s", (name, holder))
+
+
+def create_broadcast_shards(broadcast_id: str, shards: int):
+    with db_cursor() as c:
+        c.executemany(
+            "INSERT IGNORE INTO broadcast_shards (broadcast_id, shard) VALUES (%s, %s)",
+            [(broadcast_id, shard) for shard in range(shards)],
+        )
+
+
+def claim_broadcast_shard(broadcast_id: str, holder: str, ttl: float) -> Optional[int]:
+    """Lease the first unfinished shard nobody holds (or whose holder stopped renewing)."""
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE broadcast_shards
+                SET holder = %s, expires_at = NOW(3) + INTERVAL %s MICROSECOND
+              WHERE broadcast_id = %s AND NOT finished
+                AND (holder IS NULL OR expires_at < NOW(3))
+           ORDER BY shard
+              LIMIT 1
+         """, (holder, int(ttl * 1_000_000), broadcast_id))
+        if c.rowcount == 0:
+            return None
+        c.execute("""
+             SELECT shard FROM broadcast_shards
+              WHERE broadcast_id = %s AND holder = %s AND NOT finished
+           ORDER BY shard
+              LIMIT 1
+         """, (broadcast_id, holder))
+        return c.fetchone()[0]
+
+
+def renew_broadcast_shard(broadcast_id: str, shard: int, holder: str, ttl: float) -> bool:
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE broadcast_shards
+                SET expires_at = NOW(3) + INTERVAL %s MICROSECOND
+              WHERE broadcast_id = %s AND shard = %s AND holder = %s
+         """, (int(ttl * 1_000_000), broadcast_id, shard, holder))
+        return c.rowcount > 0
+
+
+def finish_broadcast_shard(broadcast_id: str, shard: int, holder: str) -> bool:
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE broadcast_shards SET finished = TRUE
+              WHERE broadcast_id = %s AND shard = %s AND holder = %s
+         """, (broadcast_id, shard, holder))
+        return c.rowcount > 0
+
+
+def count_unfinished_broadcast_shards(broadcast_id: str) -> int:
+    with db_cursor() as c:
+        c.execute("""
+             SELECT COUNT(*) FROM broadcast_shards
+              WHERE broadcast_id = %s AND NOT finished
+         """, (broadcast_id,))
+        return c.fetchone()[0]
+
+
+def count_broadcast_senders() -> int:
+    """Processes holding a live lease on a shard of any broadcast, i.e. sending right now."""
+    with db_cursor() as c:
+        # holder is "<instance id>/<8 hex digits>", one per run; the instance is what shares a pacer
+        c.execute("""
+             SELECT COUNT(DISTINCT LEFT(holder, CHAR_LENGTH(holder) - 9))
+               FROM broadcast_shards
+              WHERE NOT finished AND expires_at > NOW(3)
+         """)
+        return c.fetchone()[0]
+
+
+def fetch_broadcast_totals(broadcast_id: str) -> Dict[str, int]:
+    """Messages sent and failed so far in a broadcast, across all instances."""
+    with db_cursor() as c:
+        c.execute("""
+             SELECT delivered, COUNT(*) FROM broadcast_deliveries
+              WHERE broadcast_id = %s
+           GROUP BY delivered
+         """, (broadcast_id,))
+        counts = dict(c.fetchall())
+        return {"sent": counts.get(1, 0), "failed": counts.get(0, 0)}
+
+
+def prune_broadcast_history(before_day: str, batch_size: int = 10000) -> int:
+    """
+    Delete broadcast checkpoints and shard leases of broadcasts from before
+    `before_day` (ISO date), in small batches. Returns how many rows went.
+    """
+    removed = 0
+    for table in ("broadcast_deliveries", "broadcast_shards"):
+        with db_cursor() as c:
+            # Ids look like "<kind>:<date>[:<slots>]"; DISTINCT on the primary key prefix is a loose index scan
+            c.execute(f"SELECT DISTINCT broadcast_id FROM {table}")
+            old_ids = [row[0] for row in c.fetchall() if row[0].split(":")[1] < before_day]
+        for broadcast_id in old_ids:
+            while True:
+                with db_cursor() as c:
+                    c.execute(f"DELETE FROM {table} WHERE broadcast_id = %s LIMIT %s", (broadcast_id, batch_size))
+                    deleted = c.rowcount
+                removed += deleted
+                if deleted < batch_size:
+                    break
+    with db_cursor() as c:
+        c.execute("""
+             DELETE FROM leases
+              WHERE (name LIKE 'report:%' OR name LIKE 'announce:%') AND expires_at < NOW(3)
+         """)
+        removed += c.rowcount
+        # Snapshots of processes that are gone (see report_instance_state)
+        c.execute("DELETE FROM bot_state WHERE name LIKE 'instance:%' AND updated_at < NOW() - INTERVAL 1 DAY")
+        removed += c.rowcount
+    return removed
+
+
+def enqueue_task(kind: str, payload: Any = None, dedupe_key: Optional[str] = None, delay: float = 0) -> bool:
+    """
+    Queue a task to run after `delay` seconds. A task with the same
+    `dedupe_key` is only ever queued once; returns whether this call queued it.
+    """
+    with db_cursor() as c:
+        c.execute("""
+             INSERT IGNORE INTO tasks (kind, payload, dedupe_key, available_at)
+             VALUES (%s, %s, %s, NOW(3) + INTERVAL %s MICROSECOND)
+         """, (kind, json.dumps(payload), dedupe_key, int(delay * 1_000_000)))
+        return c.rowcount > 0
+
+
+def claim_task(holder: str, visibility: float, max_attempts: int) -> Optional[Dict[str, Any]]:
+    """
+    Take the next due task: a queued one whose time has come, or a running one
+    whose worker stopped extending it. It stays ours for `visibility` seconds.
+    Tasks whose last attempt was lost that way are failed instead.
+    """
+    with db_cursor(dictionary=True) as c:
+        c.execute("""
+             UPDATE tasks SET status = 'failed', last_error = 'worker lost on the last attempt'
+              WHERE status = 'running' AND available_at <= NOW(3) AND attempts >= %s
+         """, (max_attempts,))
+        # LAST_INSERT_ID(id) hands the id of the row this UPDATE picked back to us
+        c.execute("""
+             UPDATE tasks
+                SET status = 'running', claimed_by = %s, attempts = attempts + 1,
+                    available_at = NOW(3) + INTERVAL %s MICROSECOND, id = LAST_INSERT_ID(id)
+              WHERE status IN ('queued', 'running') AND available_at <= NOW(3)
+           ORDER BY available_at
+              LIMIT 1
+         """, (holder, int(visibility * 1_000_000)))
+        if c.rowcount == 0:
+            return None
+        c.execute("SELECT id, kind, payload, attempts FROM tasks WHERE id = LAST_INSERT_ID()")
+        task = c.fetchone()
+    task["payload"] = json.loads(task["payload"]) if task["payload"] else None
+    return task
+
+
+def extend_task(task_id: int, holder: str, attempt: int, visibility: float) -> bool:
+    """
+    Push the visibility deadline of a running task out. Like the updates
+    below, it only applies while `holder` and `attempt` still match, so a
+    worker whose claim was taken over can no longer change the task.
+    """
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE tasks SET available_at = NOW(3) + INTERVAL %s MICROSECOND
+              WHERE id = %s AND claimed_by = %s AND attempts = %s AND status = 'running'
+         """, (int(visibility * 1_000_000), task_id, holder, attempt))
+        return c.rowcount > 0
+
+
+def complete_task(task_id: int, holder: str, attempt: int) -> bool:
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE tasks SET status = 'done', available_at = NOW(3), last_error = NULL
+              WHERE id = %s AND claimed_by = %s AND attempts = %s AND status = 'running'
+         """, (task_id, holder, attempt))
+        return c.rowcount > 0
+
+
+def fail_task(task_id: int, holder: str, attempt: int, error: str, max_attempts: int, retry_delay: float) -> bool:
+    """Queue the task again after a backoff, or fail it for good; returns whether it will be retried."""
+    retry = attempt < max_attempts
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE tasks
+                SET status = %s, available_at = NOW(3) + INTERVAL %s MICROSECOND, last_error = %s
+              WHERE id = %s AND claimed_by = %s AND attempts = %s AND status = 'running'
+         """, ("queued" if retry else "failed", int(retry_delay * 2 ** (attempt - 1) * 1_000_000),
+               error[:2000], task_id, holder, attempt))
+    return retry
+
+
+def release_task(task_id: int, holder: str, attempt: int):
+    """Hand a task back untouched (on shutdown); the interrupted attempt does not count."""
+    with db_cursor() as c:
+        c.execute("""
+             UPDATE tasks SET status = 'queued', available_at = NOW(3), attempts = attempts - 1
+              WHERE id = %s AND claimed_by = %s AND attempts = %s AND status = 'running'
+         """, (task_id, holder, attempt))
+
+
+def fetch_task_queue_depth() -> List[tuple]:
+    with db_cursor() as c:
+        c.execute("""
+             SELECT kind, status, COUNT(*) FROM tasks
+              WHERE status IN ('queued', 'running')
+           GROUP BY kind, status
+         """)
+        return c.fetchall()
+
+
+def prune_tasks(before_day: str, batch_size: int = 10000) -> int:
+    """Delete finished and failed tasks last touched before `before_day` (ISO date)."""
+    removed = 0
+    while True:
+        with db_cursor() as c:
+            c.execute("""
+                 DELETE FROM tasks
+                  WHERE status IN ('done', 'failed') AND updated_at < %s
+                  LIMIT %s
+             """, (before_day, batch_size))
+            deleted = c.rowcount
+        removed += deleted
+        if deleted < batch_size:
+            return removed
+
+
+# Columns of daily_stats that events can increment
+DAILY_STAT_FIELDS = ("wallpapers_received", "wallpapers_used", "usage_replies")
+
+# daily_stats row holding each group's totals from before the table existed
+STATS_BASELINE_DAY = "1970-01-01"
+
+
+def daily_stat_upsert_sql(field: str) -> str:
+    """INSERT ... ON DUPLICATE KEY statement adding (day, user_group, amount) to one daily_stats column."""
+    if field not in DAILY_STAT_FIELDS:
+        raise ValueError(f"Unknown daily stat {field}")
+    return f"""
+         INSERT INTO daily_stats (day, user_group, {field})
+         VALUES (%s, %s, %s)
+         ON DUPLICATE KEY UPDATE {field} = {field} + VALUES({field})
+     """
+
+
+def apply_buffered_writes(counters: Dict[int, Dict[str, int]], daily_stats: Dict[tuple, int]):
+    """
+    Apply a batch of buffered writes in a single transaction:
+    atomic counter increments on users and daily_stats upserts.
+    """
+    with db_cursor() as c:
+        if counters:
+            c.executemany("""
+                 UPDATE users
+                    SET wallpapers_used = wallpapers_used + %s,
+                        wallpapers_received = wallpapers_received + %s
+                  WHERE user_id = %s
+             """, [
+                (deltas.get("wallpapers_used", 0), deltas.get("wallpapers_received", 0), user_id)
+                for user_id, deltas in counters.items()
+            ])
+        for field in DAILY_STAT_FIELDS:
+            rows = [(day, group, amount) for (day, group, f), amount in daily_stats.items() if f == field]
+            if rows:
+                c.executemany(daily_stat_upsert_sql(field), rows)
+
+
+def fetch_daily_stats(since) -> List[Dict[str, Any]]:
+    """Per-(day, group) rows from `since` (a date) onwards."""
+    with db_cursor(dictionary=True) as c:
+        c.execute("""
+             SELECT day, user_group, wallpapers_received, wallpapers_used, usage_replies
+               FROM daily_stats
+              WHERE day >= %s
+         """, (since,))
+        return c.fetchall()
+
+
+def fetch_lifetime_stats() -> List[Dict[str, Any]]:
+    """Per-group totals over all days, including the pre-migration baseline."""
+    with db_cursor(dictionary=True) as c:
+        c.execute("""
+             SELECT user_group,
+                    SUM(wallpapers_received) AS wallpapers_received,
+                    SUM(wallpapers_used) AS wallpapers_used
+               FROM daily_stats
+           GROUP BY user_group
+         """)
+        return [{**r, "wallpapers_received": int(r["wallpapers_received"]), "wallpapers_used": int(r["wallpapers_used"])}
+                for r in c.fetchall()]
+
+
+def load_state(name: str) -> Optional[Dict[str, Any]]:
+    with db_cursor() as c:
+        c.execute("SELECT value FROM bot_state WHERE name = %s", (name,))
+        row = c.fetchone()
+        return json.loads(row[0]) if row else None
+
+
+def load_states(prefix: str) -> Dict[str, Dict[str, Any]]:
+    """Every saved state whose name starts with `prefix`, by the rest of the name."""
+    with db_cursor() as c:
+        c.execute("SELECT name, value FROM bot_state WHERE name LIKE %s", (prefix + "%",))
+        return {name[len(prefix):]: json.loads(value) for name, value in c.fetchall()}
+
+
+def register_image_store(store_id: str) -> str:
+    """Record `store_id` as the image store every process uses, unless one is recorded already; returns that one."""
+    with db_cursor() as c:
+        c.execute("""
+             INSERT IGNORE INTO bot_state (name, value)
+             VALUES ('image_store', JSON_OBJECT('id', %s))
+         """, (store_id,))
+        c.execute("SELECT value FROM bot_state WHERE name = 'image_store'")
+        return json.loads(c.fetchone()[0])["id"]
+
+
+def save_state(name: str, value: Dict[str, Any]):
+    with db_cursor() as c:
+        c.execute("""
+             INSERT INTO bot_state (name, value)
+             VALUES (%s, %s)
+             ON DUPLICATE KEY UPDATE value = VALUES(value)
+         """, (name, json.dumps(value)))
+
+
+def take_bucket_token(name: str, rate: float, burst: int, floor: float, drain: bool = False) -> float:
+    """
+    Take one token from the token bucket saved in bot_state under `name`,
+    leaving at least `floor` behind. Returns 0 if a token was taken, else
+    the seconds until one will be available. `drain` empties the bucket
+    instead. The row is locked for the read-modify-write, so every process
+    sharing the database draws from the same bucket.
+    """
+    with db_cursor() as c:
+        c.execute("""
+             INSERT IGNORE INTO bot_state (name, value)
+             VALUES (%s, JSON_OBJECT('tokens', %s, 'updated_at', UNIX_TIMESTAMP(NOW(6))))
+         """, (name, burst))
+        c.execute("SELECT value, UNIX_TIMESTAMP(NOW(6)) FROM bot_state WHERE name = %s FOR UPDATE", (name,))
+        value, now = c.fetchone()
+        state, now = json.loads(value), float(now)
+        tokens = min(burst, float(state["tokens"]) + max(0.0, now - float(state["updated_at"])) * rate)
+        wait = 0.0
+        if drain:
+            tokens = 0.0
+        elif tokens >= floor + 1:
+            tokens -= 1
+        else:
+            wait = (floor + 1 - tokens) / rate
+        c.execute("UPDATE bot_state SET value = %s WHERE name = %s",
+                  (json.dumps({"tokens": tokens, "updated_at": now}), name))
+        return wait
+
+
+# -------------------------
+# ASYNC DB ACCESS
+# -------------------------
+# mysql-connector is blocking, so every DB call made from a handler or job runs
+# on this bounded executor instead of on the event loop.
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking DB function on the DB executor and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+
+async def get_or_create_user_async(user_id: int) -> Dict[str, Any]:
+    return await run_db(get_or_create_user, user_id)
+
+
+async def update_user_async(user: Dict[str, Any]):
+    await run_db(update_user, user)
+
+
+async def reserve_next_image_async(user: Dict[str, Any], category_key: str, order: str = None) -> Optional[Dict[str, Any]]:
+    img = await run_db(reserve_next_image, user, category_key, order)
+    if img:
+        write_buffer.add_daily_stat(user["group"], "wallpapers_received")
+    return img
+
+
+async def release_image_async(user: Dict[str, Any], photo_pk: int):
+    if await run_db(release_image, user, photo_pk):
+        write_buffer.add_daily_stat(user["group"], "wallpapers_received", -1)
+
+
+async def add_images_to_db_async(category_key: str, images: List[Dict[str, str]]) -> int:
+    return await run_db(add_images_to_db, category_key, images)
+
+
+async def store_image_file_ids_async(photo_pk: int, photo_file_id: Optional[str], document_file_id: Optional[str]):
+    await run_db(store_image_file_ids, photo_pk, photo_file_id, document_file_id)
+
+
+async def claim_category_click_async(user_id: int) -> bool:
+    return await run_db(claim_category_click, user_id)
+
+
+async def fetch_daily_stats_async(since) -> List[Dict[str, Any]]:
+    return await run_db(fetch_daily_stats, since)
+
+
+async def fetch_lifetime_stats_async() -> List[Dict[str, Any]]:
+    return await run_db(fetch_lifetime_stats)
+
+
+async def load_state_async(name: str) -> Optional[Dict[str, Any]]:
+    return await run_db(load_state, name)
+
+
+async def save_state_async(name: str, value: Dict[str, Any]):
+    await run_db(save_state, name, value)
+
+
+# -------------------------
+# WRITE-BEHIND BUFFER
+# -------------------------
+class WriteBuffer:
+    """
+    Collects high-frequency writes (user counters, daily stats) and
+    applies them in one transaction every `interval` seconds, or as soon as
+    `max_events` have piled up. Counter changes are summed per user and applied
+    as `x = x + n`, so nothing is lost to read-modify-write races. Writes that
+    fail to flush are put back and retried on the next flush; `close` flushes
+    whatever is left on shutdown.
+    """
+
+    def __init__(self, interval: float, max_events: int):
+        self.interval = interval
+        self.max_events = max_events
+        self._counters: Dict[int, Dict[str, int]] = {}
+        self._daily_stats: Dict[tuple, int] = {}
+        self._events = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    def _added(self):
+        self._events += 1
+        if self._events >= self.max_events and self._wakeup is not None:
+            self._wakeup.set()
+
+    def add_counter(self, user_id: int, field: str, amount: int = 1):
+        deltas = self._counters.setdefault(user_id, {})
+        deltas[field] = deltas.get(field, 0) + amount
+        user_cache.bump(user_id, field, amount)
+        self._added()
+
+    def add_daily_stat(self, user_group: str, field: str, amount: int = 1):
+        key = (datetime.now(cyprus_tz).date(), user_group, field)
+        self._daily_stats[key] = self._daily_stats.get(key, 0) + amount
+        self._added()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._events:
+                return
+            counters, daily_stats = self._counters, self._daily_stats
+            self._counters, self._daily_stats = {}, {}
+            events, self._events = self._events, 0
+            write = asyncio.ensure_future(run_db(apply_buffered_writes, counters, daily_stats))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # close() cancelled us mid-write; the write runs on a DB thread regardless, so
+                # wait for it to land and only put the batch back if it failed
+                await asyncio.wait([write])
+                if write.cancelled() or write.exception() is not None:
+                    self._put_back(counters, daily_stats, events)
+                raise
+            except Exception as e:
+                logger.error(f"Flushing {events} buffered writes failed, will retry: {e}")
+                self._put_back(counters, daily_stats, events)
+
+    def _put_back(self, counters: Dict[int, Dict[str, int]], daily_stats: Dict[tuple, int], events: int):
+        # In front of anything that arrived meanwhile
+        for user_id, deltas in counters.items():
+            merged = self._counters.setdefault(user_id, {})
+            for field, amount in deltas.items():
+                merged[field] = merged.get(field, 0) + amount
+        for key, amount in daily_stats.items():
+            self._daily_stats[key] = self._daily_stats.get(key, 0) + amount
+        self._events += events
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            await self.flush()
+
+
+write_buffer = WriteBuffer(WRITE_BUFFER_INTERVAL, WRITE_BUFFER_MAX_EVENTS)
+
+
+# -------------------------
+# MULTI-INSTANCE COORDINATION
+# -------------------------
+class LeaseLost(Exception):
+    """Another instance took over a lease we were working under."""
+
+
+class Cluster:
+    """
+    Coordinates bot instances that share one database.
+
+    Every instance keeps trying to take (or renew) the `leader` lease in the
+    leases table; whoever holds it is reported by `bot_cluster_leader`.
+    Scheduled tasks do not depend on it: every instance queues them and their
+    dedupe key keeps one per day (see `schedule_task`), so a dead leader's
+    lease cannot make a day's job go missing. If the leader dies its lease
+    runs out after LEASE_TTL and the next instance to renew takes over.
+    Leadership is only trusted locally for the TTL counted from the last
+    successful renewal, so an instance cut off from the DB stops acting as
+    leader before anyone else can take over.
+    """
+
+    LEADER_LEASE = "leader"
+
+    def __init__(self, instance_id: str, ttl: float, renew_interval: float):
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self._leader_until = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self._leader_until
+
+    async def renew(self) -> bool:
+        was_leader = self.is_leader
+        asked_at = time.monotonic()
+        try:
+            leader = await run_db(acquire_lease, self.LEADER_LEASE, self.instance_id, self.ttl)
+        except Exception as e:
+            logger.error(f"Could not renew the leader lease: {e}")
+            return self.is_leader
+        self._leader_until = asked_at + self.ttl if leader else 0.0
+        CLUSTER_LEADER.set(1 if leader else 0)
+        if leader and not was_leader:
+            logger.info(f"Instance {self.instance_id} is now the leader")
+        elif was_leader and not leader:
+            logger.warning(f"Instance {self.instance_id} lost the leader lease")
+        return leader
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await self.renew()
+            await asyncio.sleep(self.renew_interval)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+        if self.is_leader:
+            # Hand over right away instead of making the others wait for the TTL
+            self._leader_until = 0.0
+            try:
+                await run_db(release_lease, self.LEADER_LEASE, self.instance_id)
+            except Exception as e:
+                logger.error(f"Could not release the leader lease: {e}")
+
+
+cluster = Cluster(INSTANCE_ID, LEASE_TTL, LEASE_RENEW_INTERVAL)
+
+
+# -------------------------
+# TASK QUEUE
+# -------------------------
+class TaskWorker:
+    """
+    Runs tasks from the `tasks` table, `concurrency` at a time.
+
+    Each slot claims the next due task, runs its handler and acks it. While a
+    task runs its visibility deadline is pushed out every third of
+    TASK_VISIBILITY_TIMEOUT; if the worker dies the deadline passes and
+    another worker claims the task again, so handlers must be safe to re-run
+    (broadcasts and the prefetch resume from their checkpoints). A handler
+    that raises is retried with exponential backoff until TASK_MAX_ATTEMPTS.
+    On shutdown running tasks are handed straight back to the queue.
+
+    Handlers take a context like the JobQueue callbacks did: `context.bot`,
+    and the task's payload as `context.job.data`.
+    """
+
+    def __init__(self, application: Application, handlers: Dict[str, Any], concurrency: int):
+        self.application = application
+        self.handlers = handlers
+        self.concurrency = concurrency
+        self._slots: List[asyncio.Task] = []
+        self._running: Dict[int, Dict[str, Any]] = {}
+
+    def start(self):
+        self._slots = [asyncio.create_task(self._run()) for _ in range(self.concurrency)]
+        logger.info(f"Running up to {self.concurrency} queued task(s) at a time on {INSTANCE_ID}")
+
+    async def _run(self):
+        while True:
+            try:
+                task = await run_db(claim_task, INSTANCE_ID, TASK_VISIBILITY_TIMEOUT, TASK_MAX_ATTEMPTS)
+            except Exception as e:
+                logger.error(f"Could not claim a task: {e}")
+                task = None
+            if task is None:
+                await asyncio.sleep(TASK_POLL_INTERVAL)
+                continue
+            await self._execute(task)
+
+    async def _keep_visible(self, task: Dict[str, Any]):
+        while True:
+            await asyncio.sleep(TASK_VISIBILITY_TIMEOUT / 3)
+            if not await run_db(extend_task, task["id"], INSTANCE_ID, task["attempts"], TASK_VISIBILITY_TIMEOUT):
+                raise LeaseLost(f"task {task['id']} ({task['kind']})")
+
+    async def _execute(self, task: Dict[str, Any]):
+        kind = task["kind"]
+        logger.info(f"Running task {task['id']} ({kind}), attempt {task['attempts']}")
+        self._running[task["id"]] = task
+        keeper = asyncio.create_task(self._keep_visible(task))
+        work = asyncio.create_task(self._call(task))
+        try:
+            # Finishes with the handler, or fails as soon as another worker took the task over
+            done, _ = await asyncio.wait([keeper, work], return_when=asyncio.FIRST_COMPLETED)
+            for finished in done:
+                finished.result()
+        except LeaseLost as e:
+            logger.warning(f"Lost {e} to another worker, leaving it to them")
+            TASKS.inc(kind=kind, result="lost")
+        except Exception as e:
+            logger.error(f"Task {task['id']} ({kind}) failed: {e}")
+            try:
+                retry = await run_db(fail_task, task["id"], INSTANCE_ID, task["attempts"], str(e),
+                                     TASK_MAX_ATTEMPTS, TASK_RETRY_DELAY)
+                TASKS.inc(kind=kind, result="retried" if retry else "failed")
+            except Exception as db_error:
+                logger.error(f"Could not record the failure of task {task['id']}: {db_error}")
+        else:
+            try:
+                await run_db(complete_task, task["id"], INSTANCE_ID, task["attempts"])
+                TASKS.inc(kind=kind, result="done")
+            except Exception as e:
+                logger.error(f"Could not ack task {task['id']}, it will run again: {e}")
+        finally:
+            keeper.cancel()
+            work.cancel()
+        # Left in place when we are cancelled, so close() can hand it back
+        self._running.pop(task["id"], None)
+
+    async def _call(self, task: Dict[str, Any]):
+        handler = self.handlers.get(task["kind"])
+        if handler is None:
+            raise ValueError(f"no handler for task kind '{task['kind']}'")
+        context = SimpleNamespace(
+            application=self.application,
+            bot=self.application.bot,
+            job=SimpleNamespace(name=task["kind"], data=task["payload"]),
+        )
+        await handler(context)
+
+    async def close(self):
+        for slot in self._slots:
+            slot.cancel()
+        await asyncio.gather(*self._slots, return_exceptions=True)
+        # Whatever was cut short goes back to the queue for the next worker
+        for task in list(self._running.values()):
+            try:
+                await run_db(release_task, task["id"], INSTANCE_ID, task["attempts"])
+            except Exception as e:
+                logger.error(f"Could not hand back task {task['id']}, it will be retried after its timeout: {e}")
+
+
+async def queue_daily_task(kind: str):
+    """Queue today's `kind` task; the dedupe key makes it one per day, whichever instance gets there first."""
+    day = datetime.now(cyprus_tz).date().isoformat()
+    if await run_db(enqueue_task, kind, dedupe_key=f"{kind}:{day}"):
+        logger.info(f"Queued task {kind} for {day}")
+
+
+def schedule_task(kind: str):
+    """A JobQueue callback that only queues a `kind` task for the workers. Every bot instance runs it."""
+    async def enqueue(context: ContextTypes.DEFAULT_TYPE):
+        await queue_daily_task(kind)
+    enqueue.__name__ = f"enqueue_{kind}"
+    return enqueue
+
+
+async def queue_missed_tasks(schedule):
+    """
+    Queue today's tasks whose time has already passed, in case no instance
+    was up to do it (e.g. a single instance restarting after a crash). The
+    ones that were queued in time are left alone by their dedupe key.
+    """
+    now = datetime.now(cyprus_tz).time()
+    for kind, at in schedule:
+        if now >= at:
+            try:
+                await queue_daily_task(kind)
+            except Exception as e:
+                logger.error(f"Could not queue missed task {kind}: {e}")
+
+
+# -------------------------
+# FETCH FROM UNSPLASH
+# -------------------------
+class UnsplashUnavailable(Exception):
+    """
+    Unsplash could not serve a request; `reason` is "quota", "timeout",
+    "unavailable" or "error", or "circuit_open"/"budget" if it was not asked.
+    """
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+
+    Closed: calls go through. After `failure_threshold` consecutive failures
+    (or right away through `trip`, e.g. when the quota is gone) it opens and
+    `allow()` refuses calls for a cooldown. Once that has passed, one probe
+    call is let through (half-open): success closes the breaker, failure
+    opens it again for twice as long, up to `max_cooldown`.
+    Only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float, max_cooldown: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = "closed"
+        self.reason: Optional[str] = None
+        self.times_opened = 0  # since the process started
+        self._failures = 0
+        self._current_cooldown = cooldown
+        self._open_until = 0.0
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        """True while calls would be refused, i.e. callers should not count on the upstream."""
+        return self.state != "closed" and (time.monotonic() < self._open_until or self._probing)
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if time.monotonic() < self._open_until or self._probing:
+            return False
+        self.state = "half_open"
+        self._probing = True
+        return True
+
+    def release(self):
+        """Give back a probe that `allow()` let through but that was never made."""
+        self._probing = False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"{self.name} circuit closed again")
+        self.state = "closed"
+        self.reason = None
+        self._failures = 0
+        self._probing = False
+        self._current_cooldown = self.cooldown
+
+    def record_failure(self, reason: str):
+        self._failures += 1
+        if self.state == "half_open":
+            self._current_cooldown = min(self.max_cooldown, self._current_cooldown * 2)
+            self.trip(reason, self._current_cooldown)
+        elif self._failures >= self.failure_threshold:
+            self.trip(reason, self._current_cooldown)
+
+    def trip(self, reason: str, cooldown: float):
+        """Open now for `cooldown` seconds."""
+        if not self.is_open:
+            self.times_opened += 1
+            logger.warning(f"{self.name} circuit open for {cooldown:.0f}s ({reason})")
+        self.state = "open"
+        self.reason = reason
+        self._probing = False
+        self._open_until = max(self._open_until, time.monotonic() + cooldown)
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until the next probe call will be let through."""
+        if self.state == "closed":
+            return 0.0
+        return max(0.0, self._open_until - time.monotonic())
+
+    def describe(self) -> str:
+        if self.state == "closed":
+            return "closed"
+        if self.is_open and not self._probing:
+            return f"open ({self.reason}, {max(0.0, self._open_until - time.monotonic()) / 60:.0f} min left)"
+        return f"half-open ({self.reason})"
+
+
+unsplash_breaker = CircuitBreaker(
+    "Unsplash",
+    UNSPLASH_BREAKER_FAILURES,
+    UNSPLASH_BREAKER_COOLDOWN,
+    UNSPLASH_BREAKER_MAX_COOLDOWN,
+)
+
+
+class UnsplashClient:
+    """
+    Async Unsplash API client sharing one keep-alive aiohttp session.
+
+    5xx responses and dropped connections are retried with full-jitter
+    exponential backoff; when Unsplash still cannot serve the request,
+    UnsplashUnavailable says why. The X-Ratelimit-* headers of every response
+    are recorded in `rate_limit_remaining` / `rate_limit_limit`.
+    """
+
+    def __init__(self, access_key: str, base_url: str, connect_timeout: float, read_timeout: float,
+                 max_retries: int, backoff_base: float):
+        self.access_key = access_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.rate_limit_remaining: Optional[int] = None
+        self.rate_limit_limit: Optional[int] = None
+        self.rate_limit_seen_at: Optional[datetime] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily so that it is bound to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=self.timeout,
+                connector=aiohttp.TCPConnector(limit=10, keepalive_timeout=60),
+                headers={"Accept-Version": "v1", "Authorization": f"Client-ID {self.access_key}"},
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _record_rate_limit(self, headers):
+        remaining = headers.get("X-Ratelimit-Remaining")
+        limit = headers.get("X-Ratelimit-Limit")
+        if remaining is not None and remaining.isdigit():
+            self.rate_limit_remaining = int(remaining)
+        if limit is not None and limit.isdigit():
+            self.rate_limit_limit = int(limit)
+        if remaining is not None or limit is not None:
+            self.rate_limit_seen_at = datetime.now(cyprus_tz)
+
+    async def _backoff(self, attempt: int):
+        await asyncio.sleep(random.uniform(0, self.backoff_base * (2 ** attempt)))
+
+    async def fetch_random(self, query: str, count: int) -> List[Dict[str, str]]:
+        params = {"query": query, "count": count, "orientation": "portrait"}
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with session.get(f"{self.base_url}/photos/random", params=params) as resp:
+                    self._record_rate_limit(resp.headers)
+                    if resp.status == 200:
+                        data = await resp.json()
+                        return [{"id": item["id"], "url": item["urls"]["regular"]} for item in data]
+                    text = await resp.text()
+                    if resp.status == 403:
+                        UNSPLASH_FORBIDDEN.inc()
+                        logger.warning(f"Limit is exceeded! Unsplash returned {resp.status}: {text}")
+                        raise UnsplashUnavailable("quota")
+                    if resp.status < 500:
+                        logger.warning(f"Unsplash returned {resp.status}: {text}")
+                        return []
+                    logger.warning(f"Unsplash returned {resp.status} (attempt {attempt + 1}): {text}")
+            except (aiohttp.ServerTimeoutError, asyncio.TimeoutError):
+                # Checked before ClientConnectionError, which the sock timeouts subclass:
+                # do not stack more timeouts on top of a slow upstream
+                logger.error("Timed out fetching from Unsplash")
+                raise UnsplashUnavailable("timeout")
+            except aiohttp.ClientConnectionError as e:
+                logger.warning(f"Connection error talking to Unsplash (attempt {attempt + 1}): {e}")
+            except UnsplashUnavailable:
+                raise
+            except Exception as e:
+                logger.error(f"Error fetching from Unsplash: {e}")
+                raise UnsplashUnavailable("error")
+            if attempt < self.max_retries:
+                await self._backoff(attempt)
+        logger.error(f"Giving up on Unsplash after {self.max_retries + 1} attempts")
+        raise UnsplashUnavailable("unavailable")
+
+
+unsplash_client = UnsplashClient(
+    UNSPLASH_ACCESS_KEY,
+    UNSPLASH_API_URL,
+    connect_timeout=UNSPLASH_CONNECT_TIMEOUT,
+    read_timeout=UNSPLASH_READ_TIMEOUT,
+    max_retries=UNSPLASH_MAX_RETRIES,
+    backoff_base=UNSPLASH_BACKOFF_BASE,
+)
+
+
+class UnsplashRateLimiter:
+    """
+    Async token bucket shared by every Unsplash caller.
+
+    Tokens refill continuously at `per_hour / 3600` per second up to `burst`,
+    so requests are spread evenly over the hour instead of bursting and then
+    stalling. The bucket lives in `bot_state` and every token is taken under
+    a row lock, so all bot and worker processes share one budget and a
+    restart does not hand out a fresh hour of quota.
+
+    Interactive callers (user taps) may use every token but only wait up to
+    `interactive_max_wait`. Background callers (nightly prefetch) wait as long
+    as needed but leave `interactive_reserve` tokens for users.
+    """
+
+    STATE_NAME = "unsplash_rate_limiter"
+
+    def __init__(self, per_hour: int, burst: int, interactive_reserve: int, interactive_max_wait: float):
+        self.rate = per_hour / 3600.0
+        self.burst = burst
+        self.interactive_reserve = min(interactive_reserve, burst - 1)
+        self.interactive_max_wait = interactive_max_wait
+
+    async def acquire(self, interactive: bool = True) -> bool:
+        """Take one token. Returns False if an interactive caller would have to wait too long."""
+        floor = 0 if interactive else self.interactive_reserve
+        while True:
+            try:
+                wait = await run_db(take_bucket_token, self.STATE_NAME, self.rate, self.burst, floor)
+            except Exception as e:
+                logger.error(f"Could not take an Unsplash token: {e}")
+                return False
+            if wait == 0:
+                return True
+            if interactive and wait > self.interactive_max_wait:
+                return False
+            if not interactive:
+                logger.info(f"Unsplash budget spent, next prefetch request in {wait:.0f}s")
+            await asyncio.sleep(wait)
+
+    async def drain(self):
+        """Called when Unsplash says the quota is gone; stop everyone until tokens refill."""
+        try:
+            await run_db(take_bucket_token, self.STATE_NAME, self.rate, self.burst, 0, drain=True)
+        except Exception as e:
+            logger.error(f"Could not drain the Unsplash budget: {e}")
+
+
+unsplash_rate_limiter = UnsplashRateLimiter(
+    UNSPLASH_REQUESTS_PER_HOUR,
+    UNSPLASH_BURST,
+    UNSPLASH_INTERACTIVE_RESERVE,
+    UNSPLASH_INTERACTIVE_MAX_WAIT,
+)
+
+
+async def fetch_images_from_unsplash(query: str, count: int = 5, interactive: bool = True) -> List[Dict[str, str]]:
+    """
+    Random photos for `query`. Raises UnsplashUnavailable when Unsplash was
+    not asked (circuit open, budget spent) or did not answer, so callers can
+    tell that apart from an answer with nothing in it.
+    """
+    if not unsplash_breaker.allow():
+        logger.info(f"Unsplash circuit is {unsplash_breaker.describe()}, not fetching '{query}'")
+        raise UnsplashUnavailable("circuit_open")
+    acquired = False
+    try:
+        acquired = await unsplash_rate_limiter.acquire(interactive=interactive)
     finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+        if not acquired:
+            # Unsplash was not asked, so a half-open probe has not happened yet
+            unsplash_breaker.release()
+    if not acquired:
+        logger.warning(f"Unsplash budget exhausted, not fetching '{query}' right now")
+        raise UnsplashUnavailable("budget")
+    logger.info("Fetching from unsplash")
+    try:
+        results = await unsplash_client.fetch_random(query, count)
+    except UnsplashUnavailable as e:
+        if e.reason == "quota":
+            await unsplash_rate_limiter.drain()
+            unsplash_breaker.trip("quota", UNSPLASH_QUOTA_COOLDOWN)
+        else:
+            unsplash_breaker.record_failure(e.reason)
+        raise
+    unsplash_breaker.record_success()
+    if unsplash_client.rate_limit_remaining is not None:
+        logger.info(f"Unsplash quota remaining: {unsplash_client.rate_limit_remaining}/{unsplash_client.rate_limit_limit}")
+        if unsplash_client.rate_limit_remaining == 0:
+            await unsplash_rate_limiter.drain()
+            # Stop before the 403s start
+            unsplash_breaker.trip("quota", UNSPLASH_QUOTA_COOLDOWN)
+    return results
+
+
+# -------------------------
+# ON-DEMAND CATEGORY REFILL
+# -------------------------
+class CategoryRefiller:
+    """
+    Refills an empty category from Unsplash when a user taps it.
+
+    Concurrent callers for the same category share one in-flight
+    fetch-and-insert instead of each spending quota on the same request.
+    A category for which Unsplash just answered with nothing new is not
+    retried for `negative_ttl` seconds.
+    """
+
+    def __init__(self, page_size: int, negative_ttl: float):
+        self.page_size = page_size
+        self.negative_ttl = negative_ttl
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._empty_until: Dict[str, float] = {}
+
+    async def refill(self, category_key: str, query: str) -> int:
+        """Returns how many new images were added (by this call or the one it joined)."""
+        if self._empty_until.get(category_key, 0) > time.monotonic():
+            logger.info(f"Skipping refill of {category_key}, Unsplash had nothing new for it recently")
+            return 0
+        task = self._in_flight.get(category_key)
+        if task is None:
+            task = asyncio.create_task(self._refill(category_key, query))
+            self._in_flight[category_key] = task
+            task.add_done_callback(lambda t: self._in_flight.pop(category_key, None))
+        else:
+            logger.info(f"Joining in-flight refill of {category_key}")
+        # Shielded so one impatient caller being cancelled does not cancel the fetch for everyone else
+        return await asyncio.shield(task)
+
+    async def _refill(self, category_key: str, query: str) -> int:
+        try:
+            new_images = await fetch_images_from_unsplash(query, count=self.page_size)
+        except UnsplashUnavailable:
+            # Unsplash was not asked or did not answer, which says nothing about the category
+            return 0
+        added = await add_images_to_db_async(category_key, new_images) if new_images else 0
+        if added == 0:
+            self._empty_until[category_key] = time.monotonic() + self.negative_ttl
+        return added
+
+
+category_refiller = CategoryRefiller(REFILL_PAGE_SIZE, REFILL_NEGATIVE_TTL)
+
+
+# -------------------------
+# LOCAL IMAGE STORE
+# -------------------------
+class ImageStore:
+    """
+    Content-addressed on-disk copy of downloaded wallpapers.
+
+    Files are named by the SHA-256 of their bytes (<dir>/<sha[:2]>/<sha>) and
+    written through a temp file, so a partially downloaded image is never
+    visible. Every read re-hashes the file (through mmap, without pulling it
+    into the Python heap) and drops it if it is corrupt. A file's mtime is
+    bumped when it is read; `evict` deletes the least recently used files
+    once the store is bigger than `max_bytes`. A random id kept in the
+    directory (`store_id`) tells whether two processes share it.
+    """
 
+    CHUNK_SIZE = 64 * 1024
+    ID_FILE = ".store_id"
+
+    def __init__(self, root: str, max_bytes: int, download_timeout: float):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.timeout = aiohttp.ClientTimeout(total=download_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.root)
+
+    def path_for(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def store_id(self) -> str:
+        """The directory's id, created on first use."""
+        path = os.path.join(self.root, self.ID_FILE)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                f.write(os.urandom(8).hex())
+            try:
+                # Fails if another process got there first; theirs is kept
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        with open(path) as f:
+            return f.read().strip()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Separate from the API session: image downloads go to the CDN and must not carry our API key
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _store(self, tmp_path: str, sha256: str):
+        final_path = self.path_for(sha256)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+
+    @staticmethod
+    def _remove_if_exists(path: str):
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def download(self, url: str) -> Optional[str]:
+        """
+        Stream `url` into the store. Returns the SHA-256 of the file, or None on failure.
+        Disk writes run on the default executor so a slow disk never stalls the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        tmp_dir = os.path.join(self.root, "tmp")
+        tmp_path = os.path.join(tmp_dir, f"{os.getpid()}-{random.getrandbits(64):016x}")
+        digest = hashlib.sha256()
+        try:
+            async with self._get_session().get(url) as resp:
+                if resp.status != 200:
+                    logger.warning(f"Image download returned {resp.status} for {url}")
+                    return None
+                await loop.run_in_executor(None, functools.partial(os.makedirs, tmp_dir, exist_ok=True))
+                f = await loop.run_in_executor(None, open, tmp_path, "wb")
+                try:
+                    async for chunk in resp.content.iter_chunked(self.CHUNK_SIZE):
+                        digest.update(chunk)
+                        await loop.run_in_executor(None, f.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, f.close)
+            sha256 = digest.hexdigest()
+            await loop.run_in_executor(None, self._store, tmp_path, sha256)
+            return sha256
+        except Exception as e:
+            logger.error(f"Error downloading image {url}: {e}")
+            return None
+        finally:
+            await loop.run_in_executor(None, self._remove_if_exists, tmp_path)
 
-def check_category_limit(user: Dict[str, Any]) -> bool:
-    if user["last_category_click"]:
-        last_click = datetime.fromisoformat(user["last_category_click"])
-        if datetime.now() - last_click < timedelta(hours=12):
-            return False
-    return True
+    def _open_verified(self, sha256: str):
+        path = self.path_for(sha256)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return None
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                ok = False
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    ok = hashlib.sha256(mm).hexdigest() == sha256
+        except Exception:
+            f.close()
+            raise
+        if not ok:
+            f.close()
+            logger.warning(f"Image store file {sha256} failed its integrity check, removing it")
+            os.remove(path)
+            return None
+        os.utime(path)  # mark as recently used for eviction
+        return f
+
+    async def open_verified(self, sha256: Optional[str]):
+        """An open binary file for the image if it is in the store and intact, else None."""
+        if not self.enabled or not sha256:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._open_verified, sha256)
+        except Exception as e:
+            logger.error(f"Error reading image {sha256} from the store: {e}")
+            return None
+
+    def evict(self) -> int:
+        """Delete least recently used files until the store fits in max_bytes. Returns the number deleted."""
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            if os.path.basename(dirpath) == "tmp":
+                continue
+            for name in filenames:
+                if name == self.ID_FILE and dirpath == self.root:
+                    continue
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        deleted = 0
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            deleted += 1
+        logger.info(f"Image store holds {total / 2 ** 20:.1f} MiB after evicting {deleted} files")
+        return deleted
+
+
+image_store = ImageStore(IMAGE_STORE_DIR, IMAGE_STORE_MAX_BYTES, IMAGE_DOWNLOAD_TIMEOUT)
+
+
+def check_image_store():
+    """
+    Refuse to start on an image store directory other processes do not see:
+    the workers fill it and the bot sends from it, so a bot or worker on
+    another host with its own local directory would never find a file.
+    """
+    if not image_store.enabled:
+        return
+    local_id = image_store.store_id()
+    shared_id = register_image_store(local_id)
+    if local_id != shared_id:
+        raise SystemExit(
+            f"IMAGE_STORE_DIR '{IMAGE_STORE_DIR}' is not the image store the other processes use "
+            f"(id {local_id}, expected {shared_id}); mount the shared directory there, or delete the "
+            f"'image_store' row from bot_state if the store was recreated on purpose"
+        )
 
 
-def update_category_click(user_id: int):
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor()
-        c.execute("""
-             UPDATE users 
-                SET last_category_click = %s 
-              WHERE user_id = %s
-         """, (datetime.now().isoformat(), user_id))
-        conn.commit()
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+async def download_missing_images(limit: int):
+    """Download images that are not in the local store yet, IMAGE_DOWNLOAD_CONCURRENCY at a time."""
+    if not image_store.enabled:
+        return
+    rows = await run_db(fetch_images_without_content, limit)
+    semaphore = asyncio.Semaphore(IMAGE_DOWNLOAD_CONCURRENCY)
 
+    async def download(row):
+        async with semaphore:
+            sha256 = await image_store.download(row["image_url"])
+        if sha256:
+            await run_db(store_image_content_hash, row["image_id"], sha256)
+        return sha256
 
-# -------------------------
-# FETCH FROM UNSPLASH
-# -------------------------
-def fetch_images_from_unsplash(query: str, count: int = 5) -> List[Dict[str, str]]:
-    logger.info("Fetching from unsplash")
-    url = "https://api.unsplash.com/photos/random"
-    params = {
-        "query": query,
-        "client_id": UNSPLASH_ACCESS_KEY,
-        "count": count,
-        "orientation": "portrait"
-    }
-    results = []
-    try:
-        resp = requests.get(url, params=params, timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            for item in data:
-                results.append({
-                    "id": item["id"],
-                    "url": item["urls"]["regular"]
-                })
-        elif resp.status_code == 403:
-            logger.warning(f"Limit is exceeded! Unsplash returned {resp.status_code}: {resp.text}")
-        else:
-            logger.warning(f"Unsplash returned {resp.status_code}: {resp.text}")
-    except Exception as e:
-        logger.error(f"Error fetching from Unsplash: {e}")
-    return results
+    results = await asyncio.gather(*(download(row) for row in rows))
+    logger.info(f"Downloaded {sum(1 for r in results if r)}/{len(rows)} images into the local store")
+    await asyncio.get_running_loop().run_in_executor(None, image_store.evict)
 
 
 # -------------------------
 # BOT HANDLERS
 # -------------------------
+@timed(HANDLER_SECONDS, handler="start_command")
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.info(f"User {user_id} started")
-    user = get_or_create_user(user_id)
+    user = await get_or_create_user_async(user_id)
 
     await update.message.reply_text(
         "Hello! You will receive a wallpaper every day in the morning. Stay tuned!"
     )
 
 
+@timed(HANDLER_SECONDS, handler="wide_category_callback")
 async def wide_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await get_or_create_user_async(user_id)
     logger.info(f"User {user_id} chose wide category")
 
     _, category = query.data.split(":", 1)  # "cat:Nature"
@@ -345,326 +2899,1045 @@ async def wide_category_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.answer(f"Subcategories of {category}:", show_alert=True)
 
 
+@timed(HANDLER_SECONDS, handler="wide_subcategory_callback")
 async def wide_subcategory_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await get_or_create_user_async(user_id)
     logger.info(f"User {user_id} chose wide subcategory")
 
-    if not check_category_limit(user):
+    if not await claim_category_click_async(user_id):
         await context.bot.send_message(chat_id=user_id, text="You can get only one wallpaper a day.")
         return
 
     _, main_cat, subcat = query.data.split(":", 2)  # e.g. "subcat:Nature:Mountains"
     category_key = f"{main_cat}:{subcat}"
     user["chosen_category"] = category_key
-    update_category_click(user_id)
-    update_user(user)
+    await update_user_async(user)
 
-    await send_wallpaper_to_user(user_id, category_key, context)
+    await send_wallpaper_to_user(user, category_key, context)
 
 
+@timed(HANDLER_SECONDS, handler="narrow_category_callback")
 async def narrow_category_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await get_or_create_user_async(user_id)
     logger.info(f"User {user_id} chose narrow category")
 
-    if not check_category_limit(user):
+    if not await claim_category_click_async(user_id):
         await context.bot.send_message(chat_id=user_id, text="You can only get one wallpaper a day.")
         return
 
     _, category = query.data.split(":", 1)
     category_key = category
     user["chosen_category"] = category_key
-    update_user(user)
-    update_category_click(user_id)
+    await update_user_async(user)
 
-    await send_wallpaper_to_user(user_id, category_key, context)
+    await send_wallpaper_to_user(user, category_key, context)
 
 
-async def send_wallpaper_to_user(user_id: int, category_key: str, context: ContextTypes.DEFAULT_TYPE):
-    # 1) Check DB for unused images in the requested category
-    logger.info(f"Trying to  send wallpapers for user {user_id}")
-    images = fetch_images_from_db(category_key, user_id)
-    if not images:
-        # 2) If none in cache, fetch from Unsplash
-        new_images = fetch_images_from_unsplash(category_key, count=5)
-        if new_images:
-            add_images_to_db(category_key, new_images)
+async def send_image(send, chat_id: int, field: str, img: Dict[str, Any], file_id: Optional[str]):
+    """
+    Send a photo/document, cheapest source first: Telegram's cached file_id, then
+    the local image store, then the Unsplash URL. A source Telegram rejects is
+    skipped. Returns (message, sent_from_file_id).
+    """
+    if file_id:
+        try:
+            return await send(chat_id=chat_id, **{field: file_id}), True
+        except BadRequest as e:
+            TELEGRAM_SEND_RETRIES.inc(reason="file_id_rejected")
+            logger.warning(f"Cached {field} file_id rejected, uploading instead: {e}")
+    f = await image_store.open_verified(img["content_sha256"])
+    if f is not None:
+        try:
+            # The Bot API client reads the whole file into memory for the upload; it is one wallpaper
+            return await send(chat_id=chat_id, filename=f"{img['image_id']}.jpg", **{field: f}), False
+        except BadRequest as e:
+            logger.warning(f"Upload of {field} from the image store rejected, sending the URL instead: {e}")
+        finally:
+            f.close()
+    return await send(chat_id=chat_id, **{field: img["image_url"]}), False
+
+
+def fallback_categories(category_key: str) -> List[str]:
+    """Categories to serve from when `category_key` has nothing left: sibling subcategories, or other narrow categories."""
+    if ":" in category_key:
+        main_cat, subcat = category_key.split(":", 1)
+        others = [f"{main_cat}:{s}" for s in wide_categories.get(main_cat, []) if s != subcat]
+    else:
+        others = [c for c in narrow_categories if c != category_key]
+    # Spread the extra load instead of draining the first neighbour
+    return random.sample(others, len(others))
+
+
+async def reserve_wallpaper(user: Dict[str, Any], category_key: str) -> tuple:
+    """The image to send the user for `category_key`, reserved, and the category it came from."""
+    # 1) Claim an unused image in the requested category
+    img = await reserve_next_image_async(user, category_key)
+    if not img and not unsplash_breaker.is_open:
+        # 2) If none in cache, fetch from Unsplash (shared with anyone else waiting on this category)
+        if await category_refiller.refill(category_key, category_key):
             # Recheck the DB
-            images = fetch_images_from_db(category_key, user_id)
+            img = await reserve_next_image_async(user, category_key)
+
+    served_from = category_key
+    if not img and unsplash_breaker.is_open:
+        # 3) Unsplash is down or out of quota: rather than wait for it, serve a neighbouring category from the pool
+        for fallback in fallback_categories(category_key):
+            img = await reserve_next_image_async(user, fallback)
+            if img:
+                served_from = fallback
+                break
+        POOL_FALLBACKS.inc(result="served" if img else "empty")
+    return img, served_from
+
+
+@timed(HANDLER_SECONDS, handler="send_wallpaper_to_user")
+async def send_wallpaper_to_user(user: Dict[str, Any], category_key: str, context: ContextTypes.DEFAULT_TYPE):
+    # The caller already loaded the user for this update, reuse it instead of reading it again
+    user_id = user["user_id"]
+    logger.info(f"Trying to  send wallpapers for user {user_id}")
+    try:
+        img, served_from = await reserve_wallpaper(user, category_key)
+    except Exception as e:
+        logger.error(f"Could not reserve a wallpaper for user {user_id}: {e}")
+        await context.bot.send_message(chat_id=user_id, text="Error sending wallpaper, sorry.")
+        return
 
-    if not images:
+    if not img:
         await context.bot.send_message(
             chat_id=user_id,
             text=f"No new wallpapers for {category_key}, sorry."
         )
         return
 
-    # Pick the first one
-    img = images[0]
+    if served_from != category_key:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"No new {category_key} wallpapers right now, here is one from {served_from} instead."
+        )
+
     image_id = img["image_id"]
-    image_url = img["image_url"]
 
-    # Send to user
+    # Send to user, reusing Telegram's or our local copy of the file when we have one
     try:
-        await context.bot.send_photo(chat_id=user_id, photo=image_url)
-        await context.bot.send_document(chat_id=user_id, document=image_url)
-
-        # Mark the user as having received this image
-        mark_image_as_used(user_id, image_id)
-
-        # Update stats
-        user = get_or_create_user(user_id)
+        photo_msg, photo_cached = await send_image(
+            context.bot.send_photo, user_id, "photo", img, img["photo_file_id"]
+        )
+        doc_msg, doc_cached = await send_image(
+            context.bot.send_document, user_id, "document", img, img["document_file_id"]
+        )
+        if not (photo_cached and doc_cached):
+            await store_image_file_ids_async(
+                img["db_id"],
+                photo_msg.photo[-1].file_id if photo_msg.photo else None,
+                doc_msg.document.file_id if doc_msg.document else None,
+            )
+        # The reservation already recorded the delivery and bumped the stats
         user["wallpapers_received"] += 1
-        update_user(user)
 
     except Exception as e:
+        TELEGRAM_SEND_ERRORS.inc(reason="wallpaper")
         logger.error(f"Error sending image to user {user_id}: {e}")
+        # Give the image back so the user can get it next time
+        try:
+            await release_image_async(user, img["db_id"])
+        except Exception as release_error:
+            logger.error(f"Could not release image {image_id} for user {user_id}: {release_error}")
         await context.bot.send_message(chat_id=user_id, text="Error sending wallpaper, sorry.")
 
 
 # -------------------------------------------------------
 # 3) Nightly Prefetch Job
 # -------------------------------------------------------
-async def nightly_prefetch(context: ContextTypes.DEFAULT_TYPE):
-    """
-    This job runs once per night, fetching new images for each category/subcategory.
-    We respect ~50 requests/hour. If we hit 48 requests in the current hour,
-    we sleep for 1 hour (blocking approach).
+def prefetch_targets() -> List[tuple]:
+    """(category_key, unsplash query) pairs: narrow categories, then wide subcategories."""
+    targets = [(cat, cat) for cat in narrow_categories]
+    for main_cat, subcats in wide_categories.items():
+        targets += [(f"{main_cat}:{subcat}", subcat) for subcat in subcats]
+    return targets
 
-    Order of fetching:
-      1) Narrow categories (by category name)
-      2) Wide categories (by subcategory name)
 
-    Each category or subcategory => 1 request => fetch 5 images from Unsplash.
+def plan_prefetch(inventory: Dict[str, Dict[str, int]], budget: int) -> List[Dict[str, Any]]:
+    """
+    Decide which categories to refill tonight.
+
+    A category's headroom is the number of images the average recently active
+    user of that category has not seen yet (its stock if nobody is using it).
+    Requests go one at a time to the category with the least projected
+    headroom, each assumed to add a full page, until every category has
+    PREFETCH_TARGET_HEADROOM or the budget runs out. Categories already at
+    the target are skipped.
     """
-    logger.info("Starting nightly prefetch...")
+    heap = []
+    for cat_key, query in prefetch_targets():
+        inv = inventory.get(cat_key, {"stock": 0, "active_users": 0, "seen_total": 0})
+        if inv["active_users"]:
+            headroom = inv["stock"] - inv["seen_total"] / inv["active_users"]
+        else:
+            headroom = inv["stock"]
+        heap.append((headroom, cat_key, query))
+    heapq.heapify(heap)
 
-    requests_this_hour = 0
-    hour_start = datetime.now()
+    plan = {}
+    while budget > 0 and heap:
+        headroom, cat_key, query = heapq.heappop(heap)
+        if headroom >= PREFETCH_TARGET_HEADROOM:
+            break
+        if cat_key not in plan:
+            plan[cat_key] = {"category_key": cat_key, "query": query, "headroom": round(headroom, 1), "requests": 0}
+        plan[cat_key]["requests"] += 1
+        budget -= 1
+        heapq.heappush(heap, (headroom + PREFETCH_PAGE_SIZE, cat_key, query))
+    # Most urgent first, so an interrupted run has refilled the emptiest categories
+    return sorted(plan.values(), key=lambda p: p["headroom"])
 
-    def check_rate_limit():
-        nonlocal requests_this_hour, hour_start
-        # If we've made 45 requests in this hour, sleep for an hour
-        if requests_this_hour >= 45:
-            logger.info("Hit 45 requests this hour, sleeping for 1 hour to respect rate limit...")
-            time.sleep(3600)  # blocks for 1 hour
-            # reset counters
-            requests_this_hour = 0
-            hour_start = datetime.now()
-        else:
-            # Also, if an hour has passed since hour_start, reset automatically
-            if (datetime.now() - hour_start) > timedelta(hours=1):
-                requests_this_hour = 0
-                hour_start = datetime.now()
-
-    # 1) Prefetch for NARROW categories (just the category name)
-    for cat in narrow_categories:
-        check_rate_limit()
-        logger.info(f"Fetching from Unsplash for narrow category: {cat}")
-        new_imgs = fetch_images_from_unsplash(cat, count=5)
-        requests_this_hour += 1  # We made one request to Unsplash
-        if new_imgs:
-            add_images_to_db(cat, new_imgs)
-
-    # 2) Prefetch for WIDE subcategories
-    for main_cat, subcats in wide_categories.items():
-        for subcat in subcats:
-            check_rate_limit()
-            cat_key = f"{main_cat}:{subcat}"
-            logger.info(f"Fetching from Unsplash for wide subcategory: {cat_key}")
-            new_imgs = fetch_images_from_unsplash(subcat, count=5)
-            requests_this_hour += 1
-            if new_imgs:
-                add_images_to_db(cat_key, new_imgs)
 
-    logger.info("Nightly prefetch complete!")
+PREFETCH_STATE_NAME = "nightly_prefetch"
+
+
+@timed(JOB_SECONDS, job="nightly_prefetch")
+async def nightly_prefetch(context: ContextTypes.DEFAULT_TYPE):
+    """
+    This job runs once per night and refills the categories that are closest
+    to running out of unseen images (see plan_prefetch), fetching
+    PREFETCH_PAGE_SIZE images per request and at most PREFETCH_MAX_REQUESTS
+    requests. Requests go through the shared Unsplash token bucket, which
+    paces them evenly across the hour without blocking the event loop.
+
+    The plan and progress are saved after every request, so a run interrupted
+    by a restart resumes where it stopped instead of starting over. The plan
+    and the result are reported to the owners.
+    """
+    state = await load_state_async(PREFETCH_STATE_NAME)
+    if state and not state["finished"] and "plan" in state and time.time() - state["started_at"] < 24 * 3600:
+        logger.info(f"Resuming nightly prefetch ({state['requests_done']} requests already done)...")
+    else:
+        logger.info("Starting nightly prefetch...")
+        active_since = (datetime.now() - timedelta(days=PREFETCH_ACTIVE_DAYS)).isoformat()
+        inventory = await run_db(fetch_category_inventory, active_since)
+        plan = plan_prefetch(inventory, PREFETCH_MAX_REQUESTS)
+        state = {
+            "started_at": time.time(),
+            "plan": plan,
+            "requests_done": 0,
+            "added": {},
+            "finished": False,
+        }
+        await save_state_async(PREFETCH_STATE_NAME, state)
+        skipped = len(prefetch_targets()) - len(plan)
+        plan_text = "\n".join(
+            f"  {p['category_key']}: headroom {p['headroom']}, {p['requests']} request(s)" for p in plan
+        )
+        logger.info(f"Prefetch plan ({skipped} categories have enough stock):\n{plan_text}")
+        await notify_owners(
+            context.bot,
+            f"Nightly prefetch plan: {sum(p['requests'] for p in plan)} requests over {len(plan)} categories, "
+            f"{skipped} skipped\n{plan_text}"
+        )
+
+    # Flatten to one entry per request; requests_done says how far a previous run got
+    requests_list = [(p["category_key"], p["query"]) for p in state["plan"] for _ in range(p["requests"])]
+    for cat_key, query in requests_list[state["requests_done"]:]:
+        logger.info(f"Fetching from Unsplash for category: {cat_key}")
+        while True:
+            try:
+                new_imgs = await fetch_images_from_unsplash(query, count=PREFETCH_PAGE_SIZE, interactive=False)
+                break
+            except UnsplashUnavailable as e:
+                # Keep the request for when the circuit lets a probe through, rather than spending the plan
+                wait = max(UNSPLASH_BREAKER_COOLDOWN, unsplash_breaker.retry_in)
+                if time.time() + wait - state["started_at"] > PREFETCH_MAX_HOURS * 3600:
+                    logger.warning(f"Unsplash still unavailable ({e}), leaving the rest of the prefetch for later")
+                    await notify_owners(
+                        context.bot,
+                        f"Nightly prefetch paused after {state['requests_done']} requests: Unsplash unavailable ({e})"
+                    )
+                    return
+                logger.info(f"Unsplash unavailable ({e}), retrying the prefetch in {wait:.0f}s")
+                await asyncio.sleep(wait)
+        added = await add_images_to_db_async(cat_key, new_imgs) if new_imgs else 0
+        if new_imgs and added == 0:
+            logger.warning(f"Unsplash returned only already known photos for {cat_key}")
+        elif added:
+            logger.info(f"Added {added}/{len(new_imgs)} new images to {cat_key}")
+        state["added"][cat_key] = state["added"].get(cat_key, 0) + added
+        state["requests_done"] += 1
+        await save_state_async(PREFETCH_STATE_NAME, state)
+
+    # Pre-warm the local image store so first deliveries do not depend on the Unsplash CDN
+    await download_missing_images(IMAGE_DOWNLOADS_PER_PREFETCH)
+
+    state["finished"] = True
+    await save_state_async(PREFETCH_STATE_NAME, state)
+    result_text = "\n".join(f"  {cat_key}: +{added}" for cat_key, added in state["added"].items())
+    logger.info(f"Nightly prefetch complete!\n{result_text}")
+    await notify_owners(
+        context.bot,
+        f"Nightly prefetch complete: {sum(state['added'].values())} new images "
+        f"from {state['requests_done']} requests\n{result_text}"
+    )
 
 
 # -------------------------
-# DAILY JOB (MORNING DISTRIBUTION)
+# BROADCAST ENGINE
 # -------------------------
-async def morning_wallpaper_distribution(context: ContextTypes.DEFAULT_TYPE):
-    """Sends a category selection message to all users in the morning."""
-    logger.info("Running morning wallpaper distribution...")
-    bot = context.bot
+# Keyboards are the same for every recipient, so they are built once
+WIDE_CATEGORY_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(cat, callback_data=f"cat:{cat}")] for cat in wide_categories.keys()]
+)
+NARROW_CATEGORY_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(cat, callback_data=f"narrow_cat:{cat}")] for cat in narrow_categories]
+)
+USAGE_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Yes", callback_data="used:yes"),
+        InlineKeyboardButton("No", callback_data="used:no"),
+    ]
+])
 
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor(dictionary=True)
-        c.execute("SELECT user_id, user_group FROM users")
-        users = c.fetchall()
 
+def retry_after_seconds(e: RetryAfter) -> float:
+    # python-telegram-bot reports retry_after as int seconds or as a timedelta depending on the version
+    if isinstance(e.retry_after, timedelta):
+        return e.retry_after.total_seconds()
+    return float(e.retry_after)
+
+
+class SendPacer:
+    """Spaces out sends to stay under Telegram's global rate; RetryAfter pushes everyone back."""
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float):
+        self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+    def set_rate(self, per_second: float):
+        self.interval = 1.0 / per_second
+
+
+# Every broadcast run in this process sends through this one pacer
+broadcast_pacer = SendPacer(BROADCAST_MESSAGES_PER_SECOND)
+
+
+async def share_send_rate():
+    """Telegram's limit is per bot, so split it between the processes sending broadcasts right now."""
+    try:
+        senders = await run_db(count_broadcast_senders)
     except Exception as e:
-        logger.error(f"Database error in morning_wallpaper_distribution: {e}")
+        logger.error(f"Could not count broadcasting instances, keeping the current send rate: {e}")
         return
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+    broadcast_pacer.set_rate(BROADCAST_MESSAGES_PER_SECOND / max(1, senders))
+
 
-    for user in users:
-        user_id, group = user["user_id"], user["user_group"]
+async def notify_owners(bot, text: str, parse_mode: Optional[str] = None) -> List[Any]:
+    """Send a message to every bot owner; returns the messages that were delivered."""
+    sent = []
+    for owner_id in [BOT_OWNER_ID, BOT_OWNER_ID2, BOT_OWNER_ID3]:
         try:
-            if group == "wide":
-                keyboard = [[InlineKeyboardButton(cat, callback_data=f"cat:{cat}")] for cat in wide_categories.keys()]
-            else:
-                keyboard = [[InlineKeyboardButton(cat, callback_data=f"narrow_cat:{cat}")] for cat in narrow_categories]
+            sent.append(await bot.send_message(chat_id=owner_id, text=text, parse_mode=parse_mode))
+        except Exception as e:
+            logger.error(f"Error sending message to owner {owner_id}: {e}")
+    return sent
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(
-                chat_id=user_id,
-                text="Good morning! Choose a category for today's wallpaper:",
-                reply_markup=reply_markup
-            )
+
+async def update_owner_messages(messages: List[Any], text: str):
+    for message in messages:
+        try:
+            await message.edit_text(text)
         except Exception as e:
-            logger.error(f"Error sending morning prompt to user {user_id}: {e}")
+            logger.warning(f"Could not update progress message for owner {message.chat_id}: {e}")
 
 
-async def nightly_usage_prompt(context: ContextTypes.DEFAULT_TYPE):
-    """Asks users if they used their wallpaper at 22:00."""
-    logger.info("Running nightly usage prompt job...")
-    bot = context.bot
+async def send_with_retry(bot, pacer: SendPacer, user_id: int, text: str, reply_markup) -> bool:
+    """Send one broadcast message, honouring RetryAfter. Returns False if the user cannot be reached."""
+    for attempt in range(BROADCAST_MAX_ATTEMPTS):
+        await pacer.wait()
+        try:
+            await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+            return True
+        except RetryAfter as e:
+            delay = retry_after_seconds(e)
+            TELEGRAM_SEND_RETRIES.inc(reason="retry_after")
+            logger.warning(f"Flood control hit while messaging {user_id}, pausing sends for {delay:.0f}s")
+            pacer.pause(delay)
+        except Forbidden as e:
+            # Blocked the bot or deactivated; retrying will not help
+            TELEGRAM_SEND_ERRORS.inc(reason="forbidden")
+            logger.info(f"User {user_id} is unreachable: {e}")
+            return False
+        except (TimedOut, NetworkError) as e:
+            TELEGRAM_SEND_RETRIES.inc(reason="network")
+            logger.warning(f"Network error messaging {user_id} (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            TELEGRAM_SEND_ERRORS.inc(reason="other")
+            logger.error(f"Error messaging user {user_id}: {e}")
+            return False
+    TELEGRAM_SEND_ERRORS.inc(reason="retries_exhausted")
+    return False
+
+
+def broadcast_state_name(kind: str) -> str:
+    return f"broadcast:{kind}"
 
-    conn = get_connection()
-    c = None
+
+async def run_broadcast(bot, kind: str, audience: str, build_message, slots: tuple = (0, DELIVERY_SLOTS),
+                        join: bool = False):
+    """
+    Send one message to every user in `audience` whose delivery slot is in
+    `slots` ([lo, hi), everyone by default).
+
+    The slot range is split into BROADCAST_SHARDS shards (slots are spread
+    evenly over users, so the shards are about the same size). Every
+    instance running the broadcast claims shards one at a time under an
+    expiring lease (broadcast_shards), so the work spreads over the live
+    instances and a shard whose instance died is taken over once its lease
+    runs out. The task that starts a broadcast queues BROADCAST_SHARDS - 1
+    `broadcast_join` tasks, so idle workers anywhere pick up shards too; a
+    `join` run stops once there is nothing left to claim, while the starting
+    run waits for the other shards to finish so it can take over any whose
+    worker died.
+
+    Within a shard, users are streamed from the DB in keyset-paginated pages
+    and sent by a bounded set of workers through the process's SendPacer,
+    whose rate is split between the processes sending and re-read every time
+    a shard lease is renewed. Every delivery is checkpointed in
+    broadcast_deliveries under today's broadcast id, so running the same
+    broadcast again the same day (e.g. after a crash) only reaches the users
+    who have not got it yet.
+
+    A broadcast spread over a delivery window is made of several runs, one
+    per slot range; they share the day's broadcast id (and so its
+    checkpoints), while shards are tracked per run. Owners hear when the
+    first range starts and when the last one is done.
+
+    `build_message(user_row)` returns the (text, reply_markup) for a user.
+    """
+    broadcast_id = f"{kind}:{datetime.now(cyprus_tz).date().isoformat()}"
+    whole = slots == (0, DELIVERY_SLOTS)
+    run_id = broadcast_id if whole else f"{broadcast_id}:{slots[0]}-{slots[1]}"
+    state = await load_state_async(broadcast_state_name(kind))
+    if not state or state["broadcast_id"] != broadcast_id:
+        state = {"broadcast_id": broadcast_id, "started_at": time.time(), "finished": False}
+        await save_state_async(broadcast_state_name(kind), state)
+    await run_db(create_broadcast_shards, run_id, BROADCAST_SHARDS)
+    # Shard leases are per run, not per process: one worker may run several of them side by side
+    holder = f"{cluster.instance_id}/{os.urandom(4).hex()}"
+    if not join:
+        for helper in range(BROADCAST_SHARDS - 1):
+            await run_db(enqueue_task, "broadcast_join", {"kind": kind, "slots": list(slots)},
+                         dedupe_key=f"broadcast_join:{run_id}:{helper}")
+
+    stats = {"sent": 0, "failed": 0}
+    started = time.monotonic()
+
+    def local_progress_text() -> str:
+        elapsed = time.monotonic() - started
+        done = stats["sent"] + stats["failed"]
+        rate = done / elapsed if elapsed > 0 else 0
+        BROADCAST_RATE.set(rate, kind=kind)
+        return (
+            f"Broadcast {broadcast_id} on {cluster.instance_id}: {stats['sent']} sent, "
+            f"{stats['failed']} failed in {elapsed:.0f}s ({rate:.1f} msg/s)"
+        )
+
+    async def progress_text(final: bool = False) -> str:
+        # Totals over every instance taking part
+        totals = await run_db(fetch_broadcast_totals, broadcast_id)
+        elapsed = time.time() - state["started_at"]
+        rate = (totals["sent"] + totals["failed"]) / elapsed if elapsed > 0 else 0
+        status = "finished" if final else "in progress"
+        return (
+            f"Broadcast {broadcast_id} {status}: {totals['sent']} sent, {totals['failed']} failed "
+            f"in {elapsed:.0f}s ({rate:.1f} msg/s)"
+        )
+
+    # One instance keeps the owners posted, so they get one progress message per broadcast
+    owner_messages = []
+    if not join and (whole or slots[0] == 0) and await run_db(acquire_lease, f"announce:{run_id}", holder, 24 * 3600):
+        if whole:
+            owner_messages = await notify_owners(bot, f"Broadcast {broadcast_id} started")
+        else:
+            await notify_owners(bot, f"Broadcast {broadcast_id} started, spread over the delivery window")
+
+    async def run_shard(shard: int):
+        pending = asyncio.Queue(maxsize=BROADCAST_CONCURRENCY * 2)
+
+        async def produce():
+            own_slots = shard_slots(slots, shard, BROADCAST_SHARDS)
+            after = (own_slots[0], 0)
+            while True:
+                rows = await run_db(fetch_broadcast_page, broadcast_id, audience, after,
+                                    BROADCAST_PAGE_SIZE, own_slots)
+                if not rows:
+                    break
+                for row in rows:
+                    await pending.put(row)
+                after = (rows[-1]["delivery_slot"], rows[-1]["user_id"])
+            for _ in range(BROADCAST_CONCURRENCY):
+                await pending.put(None)
+
+        async def consume():
+            while True:
+                row = await pending.get()
+                if row is None:
+                    return
+                text, reply_markup = build_message(row)
+                delivered = await send_with_retry(bot, broadcast_pacer, row["user_id"], text, reply_markup)
+                stats["sent" if delivered else "failed"] += 1
+                BROADCAST_MESSAGES.inc(kind=kind, result="sent" if delivered else "failed")
+                try:
+                    await run_db(record_broadcast_delivery, broadcast_id, row["user_id"], delivered)
+                except Exception as e:
+                    logger.error(f"Could not checkpoint broadcast {broadcast_id} for user {row['user_id']}: {e}")
+
+        async def keep_lease():
+            while True:
+                await asyncio.sleep(LEASE_RENEW_INTERVAL)
+                if not await run_db(renew_broadcast_shard, run_id, shard, holder, LEASE_TTL):
+                    raise LeaseLost(f"shard {shard} of {run_id}")
+                await share_send_rate()
+
+        workers = [asyncio.create_task(produce())] + [asyncio.create_task(consume()) for _ in range(BROADCAST_CONCURRENCY)]
+        lease = asyncio.create_task(keep_lease())
+        try:
+            # Finishes when the workers do, or fails as soon as the lease is lost
+            done, _ = await asyncio.wait([lease, asyncio.gather(*workers)], return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            lease.cancel()
+            for task in workers:
+                task.cancel()
+
+    async def report():
+        while True:
+            await asyncio.sleep(BROADCAST_REPORT_INTERVAL)
+            logger.info(local_progress_text())
+            if owner_messages:
+                await update_owner_messages(owner_messages, await progress_text())
+
+    reporter = asyncio.create_task(report())
     try:
-        c = conn.cursor(dictionary=True)
-        c.execute("SELECT user_id FROM users WHERE wallpapers_received > 0")
-        users = c.fetchall()
+        while True:
+            shard = await run_db(claim_broadcast_shard, run_id, holder, LEASE_TTL)
+            if shard is None and join:
+                logger.info(local_progress_text())
+                return
+            if shard is None:
+                if await run_db(count_unfinished_broadcast_shards, run_id) == 0:
+                    break
+                # The rest is claimed by other instances; stay around in case one of them dies
+                await asyncio.sleep(LEASE_RENEW_INTERVAL)
+                continue
+            await share_send_rate()
+            try:
+                await run_shard(shard)
+            except LeaseLost as e:
+                logger.warning(f"Lost the lease on {e}, another instance is finishing it")
+                continue
+            await run_db(finish_broadcast_shard, run_id, shard, holder)
     except Exception as e:
-        logger.error(f"Database error in nightly_usage_prompt: {e}")
-        return
+        logger.error(f"Broadcast {broadcast_id} aborted, it will resume when its task is retried: {e}")
+        await update_owner_messages(owner_messages, f"Broadcast {broadcast_id} aborted on {cluster.instance_id}: {e}")
+        raise
     finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+        reporter.cancel()
 
-    for user in users:
-        user_id = user["user_id"]
-        try:
-            keyboard = [
-                [
-                    InlineKeyboardButton("Yes", callback_data="used:yes"),
-                    InlineKeyboardButton("No", callback_data="used:no"),
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await bot.send_message(
-                chat_id=user_id,
-                text="Would you set this image as your wallpaper?",
-                reply_markup=reply_markup
-            )
-        except Exception as e:
-            logger.error(f"Error prompting user {user_id}: {e}")
+    logger.info(local_progress_text())
+    if slots[1] != DELIVERY_SLOTS:
+        return
+    # Every instance gets here once the last shard is done; the first one through reports it
+    if not await run_db(acquire_lease, f"report:{run_id}", holder, 24 * 3600):
+        return
+    state["finished"] = True
+    await save_state_async(broadcast_state_name(kind), state)
+    text = await progress_text(final=True)
+    logger.info(text)
+    if owner_messages:
+        await update_owner_messages(owner_messages, text)
+    else:
+        await notify_owners(bot, text)
+
+
+def morning_prompt(user: Dict[str, Any]):
+    markup = WIDE_CATEGORY_MARKUP if user["user_group"] == "wide" else NARROW_CATEGORY_MARKUP
+    return "Good morning! Choose a category for today's wallpaper:", markup
+
+
+def usage_prompt(user: Dict[str, Any]):
+    return "Would you set this image as your wallpaper?", USAGE_MARKUP
+
+
+# Broadcast kind -> (audience, build_message)
+BROADCASTS = {
+    "morning": ("all", morning_prompt),
+    "nightly_usage": ("received", usage_prompt),
+}
 
 
+@timed(JOB_SECONDS, job="broadcast_join")
+async def broadcast_join(context: ContextTypes.DEFAULT_TYPE):
+    """Helps send the shards of a broadcast another task started."""
+    audience, build_message = BROADCASTS[context.job.data["kind"]]
+    await run_broadcast(context.bot, context.job.data["kind"], audience, build_message,
+                        slots=tuple(context.job.data["slots"]), join=True)
+
+
+# -------------------------
+# DAILY JOB (MORNING DISTRIBUTION)
+# -------------------------
+@timed(JOB_SECONDS, job="morning_wallpaper_distribution")
+async def morning_wallpaper_distribution(context: ContextTypes.DEFAULT_TYPE):
+    """Sends a category selection message to all users in the morning, spread over the delivery window."""
+    logger.info("Running morning wallpaper distribution...")
+    if MORNING_WINDOW_MINUTES <= 0:
+        await run_broadcast(context.bot, "morning", "all", morning_prompt)
+        return
+    await schedule_morning_ticks()
+
+
+def morning_tick_count() -> int:
+    return max(1, MORNING_WINDOW_MINUTES * 60 // MORNING_TICK_SECONDS)
+
+
+def morning_tick_slots(tick: int) -> tuple:
+    """Delivery slot range [lo, hi) sent by one tick of the morning window."""
+    ticks = morning_tick_count()
+    return tick * DELIVERY_SLOTS // ticks, (tick + 1) * DELIVERY_SLOTS // ticks
+
+
+async def schedule_morning_ticks():
+    """
+    Queue a task for every tick of today's morning window, each held back
+    until its time. Ticks whose time has already passed (the task ran late)
+    are due at once. Dedupe keys make a second call queue nothing new.
+    """
+    ticks = morning_tick_count()
+    now = datetime.now(cyprus_tz)
+    start = cyprus_tz.localize(datetime.combine(now.date(), MORNING_TIME))
+    for tick in range(ticks):
+        lo, hi = morning_tick_slots(tick)
+        due = start + timedelta(seconds=tick * MORNING_TICK_SECONDS)
+        await run_db(
+            enqueue_task, "morning_slots", [lo, hi],
+            dedupe_key=f"morning_slots:{now.date().isoformat()}:{lo}-{hi}",
+            delay=max(0.0, (due - now).total_seconds()),
+        )
+
+
+@timed(JOB_SECONDS, job="morning_slot_tick")
+async def morning_slot_tick(context: ContextTypes.DEFAULT_TYPE):
+    """Sends the morning prompt to the users whose delivery slot falls in this tick."""
+    await run_broadcast(context.bot, "morning", "all", morning_prompt, slots=tuple(context.job.data))
+
+
+@timed(JOB_SECONDS, job="nightly_usage_prompt")
+async def nightly_usage_prompt(context: ContextTypes.DEFAULT_TYPE):
+    """Asks users if they used their wallpaper at 22:00."""
+    logger.info("Running nightly usage prompt job...")
+    await run_broadcast(context.bot, "nightly_usage", "received", usage_prompt)
+
+
+@timed(HANDLER_SECONDS, handler="usage_callback")
 async def usage_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle the user's response to 'did you use it?'"""
     query = update.callback_query
     user_id = query.from_user.id
-    user = get_or_create_user(user_id)
+    user = await get_or_create_user_async(user_id)
     await query.answer()
 
     data = query.data  # e.g. "used:yes" or "used:no"
     _, answer = data.split(":")
     if answer == "yes":
-        user["wallpapers_used"] += 1
-        update_user(user)
+        write_buffer.add_counter(user_id, "wallpapers_used")
+        write_buffer.add_daily_stat(user["group"], "wallpapers_used")
+    write_buffer.add_daily_stat(user["group"], "usage_replies")
 
     await query.message.reply_text("Thank you for the feedback! Good night!")
 
 
-async def daily_summary(context: ContextTypes.DEFAULT_TYPE):
-    """Gathers usage stats for 'narrow' and 'wide' user groups and sends a summary to the bot owner."""
-    logger.info("Generating daily summary...")
-    bot = context.bot
+INSTANCE_STATE_PREFIX = "instance:"
+SUMMARY_BREAKER_STATE_NAME = "daily_summary:breaker_opened"
 
-    conn = get_connection()
-    c = None
-    try:
-        c = conn.cursor(dictionary=True)
 
-        # Narrow group statistics
-        c.execute("""
-             SELECT IFNULL(SUM(wallpapers_used), 0) AS used, IFNULL(SUM(wallpapers_received), 0) AS received
-             FROM users WHERE user_group = 'narrow'
-         """)
-        narrow_stats = c.fetchone()
-        narrow_used = narrow_stats["used"]
-        narrow_received = narrow_stats["received"]
-        narrow_rate = (narrow_used / narrow_received * 100) if narrow_received > 0 else 0
+def instance_state() -> Dict[str, Any]:
+    """What the daily summary needs to know about this process; it may run in another one."""
+    return {
+        "mode": BOT_MODE,
+        "reported_at": time.time(),
+        "quota_remaining": unsplash_client.rate_limit_remaining,
+        "quota_limit": unsplash_client.rate_limit_limit,
+        "quota_seen_at": unsplash_client.rate_limit_seen_at.isoformat() if unsplash_client.rate_limit_seen_at else None,
+        "breaker": unsplash_breaker.describe(),
+        "breaker_opened": unsplash_breaker.times_opened,
+        "user_cache": user_cache.stats(),
+        "seen_index": seen_index.stats(),
+    }
 
-        # Wide group statistics
-        c.execute("""
-             SELECT IFNULL(SUM(wallpapers_used), 0) AS used, IFNULL(SUM(wallpapers_received), 0) AS received
-             FROM users WHERE user_group = 'wide'
-         """)
-        wide_stats = c.fetchone()
-        wide_used = wide_stats["used"]
-        wide_received = wide_stats["received"]
-        wide_rate = (wide_used / wide_received * 100) if wide_received > 0 else 0
 
-        # Overall statistics
-        c.execute("""
-             SELECT IFNULL(SUM(wallpapers_used), 0) AS used, IFNULL(SUM(wallpapers_received), 0) AS received
-             FROM users
-         """)
-        total_stats = c.fetchone()
-        total_used = total_stats["used"]
-        total_received = total_stats["received"]
-        total_rate = (total_used / total_received * 100) if total_received > 0 else 0
+async def report_instance_state():
+    """Keep this process's snapshot in bot_state fresh, every INSTANCE_REPORT_INTERVAL."""
+    while True:
+        try:
+            await save_state_async(INSTANCE_STATE_PREFIX + INSTANCE_ID, instance_state())
+        except Exception as e:
+            logger.error(f"Could not save the instance state: {e}")
+        await asyncio.sleep(INSTANCE_REPORT_INTERVAL)
 
+
+@timed(JOB_SECONDS, job="daily_summary")
+async def daily_summary(context: ContextTypes.DEFAULT_TYPE):
+    """Sends today's usage per user group, compared with previous days, to the bot owners."""
+    logger.info("Generating daily summary...")
+    bot = context.bot
+    today = datetime.now(cyprus_tz).date()
+
+    try:
+        # Processes serving users flush their own buffers every WRITE_BUFFER_INTERVAL
+        await write_buffer.flush()
+        rows = await fetch_daily_stats_async(today - timedelta(days=STATS_TREND_DAYS))
+        lifetime = await fetch_lifetime_stats_async()
+        await save_state_async(INSTANCE_STATE_PREFIX + INSTANCE_ID, instance_state())
+        instances = await run_db(load_states, INSTANCE_STATE_PREFIX)
+        opened_before = await load_state_async(SUMMARY_BREAKER_STATE_NAME) or {}
     except Exception as e:
         logger.error(f"Database error in daily_summary: {e}")
         return
-    finally:
-        if c is not None:
-            c.close()  # Close only if 'c' was successfully created
-        conn.close()
+
+    def totals(source, group=None, day=None):
+        picked = [r for r in source if (group is None or r["user_group"] == group) and (day is None or r["day"] == day)]
+        return {
+            "received": sum(r["wallpapers_received"] for r in picked),
+            "used": sum(r["wallpapers_used"] for r in picked),
+            "replies": sum(r.get("usage_replies", 0) for r in picked),
+        }
+
+    def rate(stats):
+        return (stats["used"] / stats["received"] * 100) if stats["received"] > 0 else 0
+
+    def section(title, group=None):
+        now = totals(rows, group, today)
+        before = totals(rows, group, today - timedelta(days=1))
+        # Average over the previous days only, so today's partial numbers do not skew it
+        history = [totals(rows, group, today - timedelta(days=d)) for d in range(1, STATS_TREND_DAYS + 1)]
+        history_rate = rate({k: sum(h[k] for h in history) for k in ("received", "used")})
+        total = totals(lifetime, group)
+        return (
+            f"**{title}:**\n"
+            f"  📌 Received Today: {now['received']} ({now['received'] - before['received']:+d} vs yesterday)\n"
+            f"  ✅ Used Today: {now['used']} ({now['used'] - before['used']:+d} vs yesterday)\n"
+            f"  💬 Feedback Replies Today: {now['replies']}\n"
+            f"  📈 Usage Rate: {rate(now):.2f}% ({STATS_TREND_DAYS}-day avg {history_rate:.2f}%)\n"
+            f"  🗂 Lifetime: {total['received']} received, {total['used']} used ({rate(total):.2f}%)\n\n"
+        )
+
+    # Processes that reported recently; the quota and circuit are seen by whoever calls Unsplash
+    live = {
+        name: state for name, state in instances.items()
+        if time.time() - state["reported_at"] < 3 * INSTANCE_REPORT_INTERVAL
+    }
+    # times_opened counts from each process's start; a lower count than last time means it restarted
+    opened_now = {name: state["breaker_opened"] for name, state in live.items()}
+    opened = sum(count - opened_before.get(name, 0) if count >= opened_before.get(name, 0) else count
+                 for name, count in opened_now.items())
+
+    def quota_section():
+        seen = [state for state in live.values() if state["quota_seen_at"]]
+        if not seen:
+            quota = "unknown (no requests yet)"
+        else:
+            latest = max(seen, key=lambda state: state["quota_seen_at"])
+            quota = (f"{latest['quota_remaining']}/{latest['quota_limit']} remaining "
+                     f"as of {datetime.fromisoformat(latest['quota_seen_at']):%H:%M}")
+        circuits = "\n".join(f"    {name} ({state['mode']}): {state['breaker']}" for name, state in sorted(live.items()))
+        return (
+            "**Unsplash:**\n"
+            f"  🔑 Quota: {quota}\n"
+            f"  🔌 Circuit opened {opened} time(s) since the last summary, now:\n{circuits}\n"
+        )
 
     summary_text = (
         "📊 **Daily Summary:**\n\n"
-        f"**Narrow Group:**\n"
-        f"  📌 Wallpapers Received: {narrow_received}\n"
-        f"  ✅ Wallpapers Used: {narrow_used}\n"
-        f"  📈 Usage Rate: {narrow_rate:.2f}%\n\n"
-        f"**Wide Group:**\n"
-        f"  📌 Wallpapers Received: {wide_received}\n"
-        f"  ✅ Wallpapers Used: {wide_used}\n"
-        f"  📈 Usage Rate: {wide_rate:.2f}%\n\n"
-        f"**Overall Statistics:**\n"
-        f"  📌 Total Received: {total_received}\n"
-        f"  ✅ Total Used: {total_used}\n"
-        f"  📈 Overall Usage Rate: {total_rate:.2f}%\n"
+        + section("Narrow Group", "narrow")
+        + section("Wide Group", "wide")
+        + section("Overall Statistics")
+        + quota_section()
     )
 
     # Send the summary to all bot owners
-    for owner_id in [BOT_OWNER_ID, BOT_OWNER_ID2, BOT_OWNER_ID3]:
-        try:
-            await bot.send_message(chat_id=owner_id, text=summary_text, parse_mode="Markdown")
-        except Exception as e:
-            logger.error(f"Error sending summary to owner {owner_id}: {e}")
+    await notify_owners(bot, summary_text, parse_mode="Markdown")
+    await save_state_async(SUMMARY_BREAKER_STATE_NAME, opened_now)
 
     logger.info("Daily summary sent successfully.")
+    for name, state in sorted(live.items()):
+        logger.info(f"{name} ({state['mode']}): user cache {state['user_cache']}, seen index {state['seen_index']}")
+
+
+@timed(JOB_SECONDS, job="prune_history")
+async def prune_history(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Drops broadcast checkpoints older than HISTORY_RETENTION_DAYS, the only
+    per-user history that can go, and finished tasks of the same age.
+    """
+    cutoff = (datetime.now(cyprus_tz).date() - timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+    try:
+        removed = await run_db(prune_broadcast_history, cutoff)
+        removed_tasks = await run_db(prune_tasks, cutoff)
+    except Exception as e:
+        logger.error(f"Pruning broadcast history failed: {e}")
+        return
+    logger.info(f"Pruned {removed} broadcast history rows and {removed_tasks} tasks from before {cutoff}")
+
+
+# -------------------------
+# UPDATE PROCESSING
+# -------------------------
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates from different users concurrently but each user's own
+    updates one at a time, in the order they arrived, so a double tap cannot
+    run two category choices side by side.
+
+    PTB admits up to `max_pending` updates at once; each waits for its user's
+    previous update first and only then for one of `concurrency` handler
+    slots, so a user tapping away queues behind themselves without taking
+    slots from everyone else.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int):
+        super().__init__(max_pending)
+        self.concurrency = concurrency
+        self._slots = asyncio.Semaphore(concurrency)
+        self._users: Dict[int, list] = {}  # user id -> [lock, updates holding or waiting for it]
+        self.queued = 0
+        self.running = 0
+        self._warned_at = 0.0
+
+    @staticmethod
+    def _user_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self._user_key(update)
+        entry = self._users.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self.queued += 1
+        if self.queued > UPDATE_QUEUE_WARN and time.monotonic() - self._warned_at > 60:
+            self._warned_at = time.monotonic()
+            logger.warning(f"{self.queued} updates waiting for a handler, {self.running} running")
+        started = False
+        try:
+            async with entry[0]:
+                async with self._slots:
+                    self.queued -= 1
+                    self.running += 1
+                    started = True
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+        finally:
+            if not started:
+                # Cancelled while waiting (shutdown)
+                self.queued -= 1
+                coroutine.close()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._users[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self.queued, "running": self.running, "users": len(self._users)}
+
+
+update_processor = PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+
+
+# -------------------------
+# METRICS ENDPOINT
+# -------------------------
+_category_pool_refreshed_at = 0.0
+
+
+def collect_runtime_metrics():
+    pool = db_pool.stats()
+    DB_POOL_CONNECTIONS.set(pool["in_use"], state="in_use")
+    DB_POOL_CONNECTIONS.set(pool["created"] - pool["in_use"], state="idle")
+    seen = seen_index.stats()
+    SEEN_INDEX_BYTES.set(seen["bytes"])
+    for kind in ("categories", "bitmaps", "users"):
+        SEEN_INDEX_ENTRIES.set(seen[kind], kind=kind)
+    if unsplash_client.rate_limit_remaining is not None:
+        UNSPLASH_REMAINING.set(unsplash_client.rate_limit_remaining)
+    if unsplash_client.rate_limit_limit is not None:
+        UNSPLASH_LIMIT.set(unsplash_client.rate_limit_limit)
+    UNSPLASH_BREAKER_OPEN.set(1 if unsplash_breaker.is_open else 0)
+    updates = update_processor.stats()
+    UPDATES_QUEUED.set(updates["queued"])
+    UPDATES_RUNNING.set(updates["running"])
+
+
+def collect_category_pool_metrics():
+    # A GROUP BY over photo_categories; scrapes come often, so only refresh it every METRICS_POOL_REFRESH seconds
+    global _category_pool_refreshed_at
+    if time.monotonic() - _category_pool_refreshed_at < METRICS_POOL_REFRESH:
+        return
+    _category_pool_refreshed_at = time.monotonic()
+    with db_cursor() as c:
+        c.execute("""
+             SELECT cat.category_key, COUNT(*)
+               FROM photo_categories pc
+               JOIN categories cat ON cat.id = pc.category_id
+           GROUP BY cat.category_key
+         """)
+        CATEGORY_POOL_IMAGES.replace({(("category", key),): count for key, count in c.fetchall()})
+
+
+def collect_task_queue_metrics():
+    TASK_QUEUE_DEPTH.replace({
+        (("kind", kind), ("status", status)): count for kind, status, count in fetch_task_queue_depth()
+    })
+
+
+metrics.add_collector(collect_runtime_metrics)
+metrics.add_collector(collect_category_pool_metrics)
+metrics.add_collector(collect_task_queue_metrics)
+
+metrics_app = Flask(__name__)
+
+
+@metrics_app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+_metrics_server = None
+
+
+def start_metrics_server():
+    """Serve /metrics from a background thread, so scrapes never touch the event loop."""
+    global _metrics_server
+    port = WORKER_METRICS_PORT if BOT_MODE == "worker" else METRICS_PORT
+    if not port:
+        return
+    try:
+        _metrics_server = make_server(METRICS_HOST, port, metrics_app, threaded=True)
+    except OSError as e:
+        # e.g. a second worker on the same host; it still works, just without /metrics
+        logger.error(f"Not serving metrics, port {port} is unavailable: {e}")
+        return
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+def stop_metrics_server():
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
 
 
 # -------------------------
 # Main
 # -------------------------
-def main():
-    # 1) init DB
-    init_db()
+# Queued task kinds and what runs them; the bot's schedule only queues them
+TASK_HANDLERS = {
+    "morning_wallpaper_distribution": morning_wallpaper_distribution,
+    "morning_slots": morning_slot_tick,
+    "broadcast_join": broadcast_join,
+    "nightly_usage_prompt": nightly_usage_prompt,
+    "daily_summary": daily_summary,
+    "nightly_prefetch": nightly_prefetch,
+    "prune_history": prune_history,
+}
+
+# Daily tasks every bot instance queues for the workers, at Cyprus time
+SCHEDULED_TASKS = [
+    ("morning_wallpaper_distribution", MORNING_TIME),
+    ("nightly_usage_prompt", dt_time(hour=22, minute=0, second=0)),
+    ("daily_summary", dt_time(hour=23, minute=0, second=0)),
+    ("nightly_prefetch", dt_time(hour=3, minute=0, second=0)),
+    ("prune_history", dt_time(hour=4, minute=30, second=0)),
+]
+
+task_worker: Optional[TaskWorker] = None
+instance_reporter: Optional[asyncio.Task] = None
+
+
+async def on_startup(application: Application):
+    global task_worker, instance_reporter
+    start_metrics_server()
+    write_buffer.start()
+    instance_reporter = asyncio.create_task(report_instance_state())
+    if BOT_MODE != "worker":
+        cluster.start()
+        await queue_missed_tasks(SCHEDULED_TASKS)
+    concurrency = WORKER_CONCURRENCY if BOT_MODE == "worker" else BOT_EMBEDDED_WORKERS
+    if concurrency > 0:
+        task_worker = TaskWorker(application, TASK_HANDLERS, concurrency)
+        task_worker.start()
+    else:
+        logger.info("Not running queued tasks here, that is left to BOT_MODE=worker processes")
+
+
+async def on_shutdown(application: Application):
+    if task_worker is not None:
+        await task_worker.close()
+    if instance_reporter is not None:
+        instance_reporter.cancel()
+    await unsplash_client.close()
+    await image_store.close()
+    await write_buffer.close()
+    await cluster.close()
+    stop_metrics_server()
+    # Let in-flight DB calls finish before the process exits
+    db_executor.shutdown(wait=True)
+
 
-    # 2) build app
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_application(worker: bool = False) -> Application:
+    """
+    The Application with every handler and scheduled task registered; shared
+    by all ways of running the bot. A `worker` one only gets the bot, to send
+    from the tasks it runs.
+    """
+    builder = ApplicationBuilder().token(BOT_TOKEN).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_BASE_URL:
+        # e.g. a local Bot API server, or the fake one used by the load tests
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    if worker:
+        builder = builder.updater(None)
+    else:
+        builder = builder.concurrent_updates(update_processor)
+    application = builder.build()
+    if worker:
+        return application
 
-    # 3) Register command/callback handlers
+    # Register command/callback handlers
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CallbackQueryHandler(wide_category_callback, pattern=r"^cat:"))
     application.add_handler(CallbackQueryHandler(wide_subcategory_callback, pattern=r"^subcat:"))
@@ -674,35 +3947,74 @@ def main():
 
     application.add_handler(CallbackQueryHandler(usage_callback, pattern=r"^used:"))
 
-    # 4) schedule jobs
-
+    # Schedule jobs; they only queue tasks for the workers
     job_queue: JobQueue = application.job_queue
-    job_queue.run_daily(
-        morning_wallpaper_distribution,
-        time=dt_time(hour=11, minute=0, second=0, tzinfo=cyprus_tz),
-        days=(0, 1, 2, 3, 4, 5, 6)
-    )
+    for kind, at in SCHEDULED_TASKS:
+        job_queue.run_daily(
+            schedule_task(kind),
+            time=at.replace(tzinfo=cyprus_tz),
+            days=(0, 1, 2, 3, 4, 5, 6)
+        )
+    return application
 
-    # Nightly usage prompt at 22:00
-    job_queue.run_daily(
-        nightly_usage_prompt,
-        time=dt_time(hour=22, minute=0, second=0, tzinfo=cyprus_tz),
-        days=(0, 1, 2, 3, 4, 5, 6)
-    )
-    # Daily summary at 23:59 (optional)
-    job_queue.run_daily(
-        daily_summary,
-        time=dt_time(hour=23, minute=0, second=0, tzinfo=cyprus_tz),
-        days=(0, 1, 2, 3, 4, 5, 6)
-    )
 
-    job_queue.run_daily(
-        nightly_prefetch,
-        time=dt_time(hour=3, minute=0, second=0, tzinfo=cyprus_tz),
-        days=(0, 1, 2, 3, 4, 5, 6)
+def run_webhook(application: Application):
+    """
+    Serve updates from the embedded webhook server instead of polling.
+    setWebhook is called on startup with WEBHOOK_SECRET, and the server drops
+    any request that does not carry it, so only Telegram can feed us updates.
+    TLS is expected to be terminated in front of it (load balancer/reverse proxy).
+    """
+    if not WEBHOOK_URL:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        raise SystemExit("BOT_MODE=webhook needs WEBHOOK_SECRET")
+    path = WEBHOOK_PATH.strip("/")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=path,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{path}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
     )
 
-    application.run_polling()
+
+async def run_worker(application: Application):
+    """
+    BOT_MODE=worker: run queued tasks until SIGTERM/SIGINT. Start as many
+    worker processes as needed; each claims tasks on its own.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with application:
+        await on_startup(application)
+        try:
+            await stop.wait()
+        finally:
+            await on_shutdown(application)
+
+
+def main():
+    # 1) init DB
+    init_db()
+    check_image_store()
+
+    # 2) build app with its handlers and jobs
+    application = build_application(worker=BOT_MODE == "worker")
+
+    # 3) serve updates, or run queued tasks
+    if BOT_MODE == "webhook":
+        run_webhook(application)
+    elif BOT_MODE == "polling":
+        application.run_polling()
+    elif BOT_MODE == "worker":
+        asyncio.run(run_worker(application))
+    else:
+        raise SystemExit(f"Unknown BOT_MODE '{BOT_MODE}', expected 'polling', 'webhook' or 'worker'")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# main reads its settings at import time; none of the tests talk to Telegram, Unsplash or MySQL
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("BOT_OWNER_ID", "1")
+os.environ.setdefault("BOT_OWNER_ID2", "2")
+os.environ.setdefault("BOT_OWNER_ID3", "3")
+os.environ.setdefault("UNSPLASH_ACCESS_KEY", "test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
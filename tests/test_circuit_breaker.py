@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+import main
+from main import CircuitBreaker
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def breaker(clock):
+    return CircuitBreaker("Test", failure_threshold=3, cooldown=60, max_cooldown=200)
+
+
+def test_opens_after_consecutive_failures(breaker):
+    breaker.record_failure("timeout")
+    breaker.record_failure("timeout")
+    assert breaker.allow()
+    breaker.record_failure("timeout")
+    assert breaker.is_open
+    assert not breaker.allow()
+    assert breaker.times_opened == 1
+
+
+def test_success_resets_the_failure_count(breaker):
+    breaker.record_failure("error")
+    breaker.record_failure("error")
+    breaker.record_success()
+    breaker.record_failure("error")
+    assert breaker.allow()
+
+
+def test_half_open_lets_one_probe_through(breaker, clock):
+    breaker.trip("quota", 60)
+    clock.now += 61
+    assert breaker.retry_in == 0
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_failed_probe_doubles_the_cooldown_up_to_the_maximum(breaker, clock):
+    for _ in range(3):
+        breaker.record_failure("error")
+    expected = 60
+    for _ in range(3):
+        clock.now += expected + 1
+        assert breaker.allow()
+        breaker.record_failure("error")
+        expected = min(200, expected * 2)
+        assert breaker.retry_in == pytest.approx(expected)
+
+
+def test_trip_keeps_the_longer_cooldown(breaker):
+    breaker.trip("quota", 600)
+    breaker.trip("error", 60)
+    assert breaker.retry_in == pytest.approx(600)
+    assert breaker.times_opened == 1
+
+
+def test_refused_probe_is_released(breaker, clock, monkeypatch):
+    async def refuse(interactive=True):
+        return False
+
+    monkeypatch.setattr(main, "unsplash_breaker", breaker)
+    monkeypatch.setattr(main.unsplash_rate_limiter, "acquire", refuse)
+    breaker.trip("quota", 60)
+    clock.now += 61
+    with pytest.raises(main.UnsplashUnavailable):
+        asyncio.run(main.fetch_images_from_unsplash("Nature"))
+    # Unsplash was never asked, so the next caller may still probe
+    assert not breaker.is_open
+    assert breaker.allow()
+    assert breaker.state == "half_open"
@@ -0,0 +1,40 @@
+from main import plan_prefetch, prefetch_targets
+
+
+def well_stocked():
+    return {cat: {"stock": 1000, "active_users": 0, "seen_total": 0} for cat, _ in prefetch_targets()}
+
+
+def test_nothing_planned_when_every_category_is_stocked():
+    assert plan_prefetch(well_stocked(), budget=10) == []
+
+
+def test_emptiest_category_gets_requests_first():
+    inventory = well_stocked()
+    inventory["Nature"] = {"stock": 0, "active_users": 0, "seen_total": 0}
+    inventory["Space"] = {"stock": 100, "active_users": 10, "seen_total": 995}  # headroom 0.5
+    plan = plan_prefetch(inventory, budget=1)
+    assert [p["category_key"] for p in plan] == ["Nature"]
+    assert plan[0]["query"] == "Nature"
+
+
+def test_budget_is_spread_by_projected_headroom():
+    inventory = well_stocked()
+    inventory["Nature"] = {"stock": 0, "active_users": 0, "seen_total": 0}
+    inventory["Space"] = {"stock": 5, "active_users": 0, "seen_total": 0}
+    plan = {p["category_key"]: p for p in plan_prefetch(inventory, budget=5)}
+    # One page lifts a category past PREFETCH_TARGET_HEADROOM, so each needs a single request
+    assert {key: p["requests"] for key, p in plan.items()} == {"Nature": 1, "Space": 1}
+
+
+def test_wide_subcategories_query_by_subcategory():
+    inventory = well_stocked()
+    inventory["Space:Galaxies"] = {"stock": 0, "active_users": 0, "seen_total": 0}
+    plan = plan_prefetch(inventory, budget=3)
+    assert plan == [{"category_key": "Space:Galaxies", "query": "Galaxies", "headroom": 0, "requests": 1}]
+
+
+def test_unknown_categories_count_as_empty_and_come_first():
+    plan = plan_prefetch({}, budget=3)
+    assert len(plan) == 3
+    assert all(p["headroom"] == 0 and p["requests"] == 1 for p in plan)
@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+from main import SeenIndex
+
+
+class FakeCursor:
+    """Answers the two queries SeenIndex sends: a category's photo pks and a user's seen photos."""
+
+    def __init__(self, categories, seen):
+        self.categories = categories  # category_id -> photo pks
+        self.seen = seen  # user_id -> photo pks
+        self.queries = 0
+        self._rows = []
+
+    def execute(self, sql, params):
+        self.queries += 1
+        if "FROM user_photos" in sql:
+            category_id, user_id = params
+            photos = set(self.categories[category_id])
+            self._rows = [{"photo_pk": pk} for pk in self.seen.get(user_id, ()) if pk in photos]
+        elif "photo_pk >" in sql:
+            category_id, after = params
+            self._rows = [{"photo_pk": pk} for pk in sorted(self.categories[category_id]) if pk > after]
+        else:
+            (category_id,) = params
+            self._rows = [{"photo_pk": pk} for pk in sorted(self.categories[category_id])]
+
+    def fetchall(self):
+        return self._rows
+
+
+@pytest.fixture
+def cursor():
+    return FakeCursor({1: [10, 20, 30, 40]}, {7: [10, 30]})
+
+
+def test_oldest_and_newest_skip_seen_photos(cursor):
+    index = SeenIndex(1024 ** 2)
+    assert index.next_unseen(cursor, 1, 7, "oldest") == 20
+    assert index.next_unseen(cursor, 1, 7, "newest") == 40
+
+
+def test_exclude_and_exhausted_category(cursor):
+    index = SeenIndex(1024 ** 2)
+    assert index.next_unseen(cursor, 1, 7, "oldest", exclude=[20]) == 40
+    assert index.next_unseen(cursor, 1, 7, "oldest", exclude=[20, 40]) is None
+
+
+def test_random_wraps_around_to_the_first_unseen(cursor, monkeypatch):
+    index = SeenIndex(1024 ** 2)
+    # Starting after the last unseen photo (ordinal 3 is seen here) wraps to the first one
+    cursor.seen[7] = [10, 40]
+    monkeypatch.setattr(random, "randrange", lambda n: 3)
+    assert index.next_unseen(cursor, 1, 7, "random") == 20
+    monkeypatch.setattr(random, "randrange", lambda n: 2)
+    assert index.next_unseen(cursor, 1, 7, "random") == 30
+
+
+def test_random_only_returns_unseen_photos(cursor):
+    index = SeenIndex(1024 ** 2)
+    picks = {index.next_unseen(cursor, 1, 7, "random") for _ in range(50)}
+    assert picks <= {20, 40}
+
+
+def test_bitmaps_are_cached_and_kept_current(cursor):
+    index = SeenIndex(1024 ** 2)
+    index.next_unseen(cursor, 1, 7, "oldest")
+    queries = cursor.queries
+    index.mark_seen(7, 20)
+    assert index.next_unseen(cursor, 1, 7, "oldest") == 40
+    index.mark_unseen(7, 10)
+    assert index.next_unseen(cursor, 1, 7, "oldest") == 10
+    assert cursor.queries == queries
+
+
+def test_new_photos_are_appended(cursor):
+    index = SeenIndex(1024 ** 2)
+    cursor.seen[7] = [10, 20, 30, 40]
+    assert index.next_unseen(cursor, 1, 7, "oldest") is None
+    cursor.categories[1].append(50)
+    assert index.extend_category(cursor, 1)
+    assert index.next_unseen(cursor, 1, 7, "oldest") == 50
+
+
+def test_photo_out_of_order_reloads_the_category(cursor):
+    index = SeenIndex(1024 ** 2)
+    index.next_unseen(cursor, 1, 7, "oldest")
+    cursor.categories[1].append(15)
+    index.add_photos(1, [15])
+    assert index.stats()["categories"] == 0
+    assert index.next_unseen(cursor, 1, 7, "oldest") == 15
+
+
+def test_bitmaps_are_evicted_past_max_bytes():
+    cursor = FakeCursor({1: list(range(1, 101))}, {})
+    index = SeenIndex(2000)
+    for user_id in range(50):
+        index.next_unseen(cursor, 1, user_id, "oldest")
+    stats = index.stats()
+    assert stats["bitmaps"] < 50
+    assert stats["bytes"] <= 2000